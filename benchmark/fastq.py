@@ -0,0 +1,70 @@
+"""
+Measure the throughput (reads/sec) of the hivmmer.filter stages, comparing
+the original Biopython SeqIO implementation against hivmmer.fastq, on plain
+and gzipped input.
+
+Usage: python fastq.py [-n READS] [FASTQ]
+"""
+import argparse
+import gzip
+import hivmmer.filter
+import os
+import shutil
+import tempfile
+import time
+from Bio import SeqIO
+
+
+def seqio_mean_filter(filename, min_length, min_quality, keep):
+    """
+    The SeqIO-based mean filter from hivmmer 0.2.1, as a baseline.
+    """
+    with (gzip.open(filename, "rt") if filename.endswith(".gz") else open(filename)) as f:
+        for seq in SeqIO.parse(f, "fastq"):
+            if len(seq) > min_length and sum(seq.letter_annotations["phred_quality"]) / len(seq) > min_quality:
+                seq = str(seq.seq)
+                keep[seq] = keep.get(seq, 0) + 1
+
+
+def replicate(fastq, nreads, outfile):
+    """
+    Write `nreads` records to `outfile` by repeating the records in `fastq`.
+    """
+    with open(fastq, "rb") as f:
+        lines = f.readlines()
+    records = [b"".join(lines[i:i+4]) for i in range(0, len(lines), 4)]
+    with (gzip.open(outfile, "wb", compresslevel=1) if outfile.endswith(".gz") else open(outfile, "wb")) as f:
+        for i in range(nreads):
+            f.write(records[i % len(records)])
+
+
+def timeit(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--reads", type=int, default=200000, help="number of reads to time [200000]")
+    parser.add_argument("FASTQ", nargs="?",
+                        default=os.path.join(os.path.dirname(__file__), "..", "test", "5VM_1.fastq"),
+                        help="FASTQ file to replicate [test/5VM_1.fastq]")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for ext in ("fastq", "fastq.gz"):
+            filename = os.path.join(tmpdir, "reads." + ext)
+            replicate(args.FASTQ, args.reads, filename)
+            for name, func, fargs in (("seqio mean_filter", seqio_mean_filter, (75, 25, {})),
+                                      ("hivmmer mean_filter", hivmmer.filter.mean_filter, (75, 25, {})),
+                                      ("hivmmer split_filter", hivmmer.filter.split_filter, (75, 25, {})),
+                                      ("hivmmer mask_filter", hivmmer.filter.mask_filter, (25, {}))):
+                elapsed = timeit(func, filename, *fargs)
+                print("{:<10} {:<22} {:>12,.0f} reads/sec".format(ext, name, args.reads / elapsed))
+    finally:
+        shutil.rmtree(tmpdir)
+
+# vim: expandtab sw=4 ts=4
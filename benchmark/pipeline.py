@@ -0,0 +1,147 @@
+"""
+Time the stages of the hivmmer pipeline on synthetic paired-end reads (see
+synthetic.py) at several scales, and write the results as JSON so that they
+can be compared across commits.
+
+At each scale, the reads are filtered and deduplicated, translated, aligned,
+and counted, followed by the consensus, AA table, DRM and plot stages. By
+default, the alignments come from the k-mer stand-in for hmmsearch in
+synthetic.py, so that the Python stages can be timed at scales where
+hmmsearch would dominate the run time; use --hmmsearch to run the real thing. Each stage is
+measured with `hivmmer.profile` (wall time, CPU time, peak RSS, bytes and
+records).
+
+Usage: python pipeline.py [-n PAIRS [PAIRS ...]] [-t THREADS] [--hmmsearch] [-o JSON]
+"""
+import argparse
+import hivmmer
+import json
+import numpy as np
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic
+
+
+def commit():
+    """
+    Returns the git commit of the hivmmer source tree, if it is a checkout.
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(hivmmer.__file__),
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              universal_newlines=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(npairs, ref, tmpdir, threads=1, hmmsearch=False, seed=0):
+    """
+    Run the pipeline stages on `npairs` synthetic read pairs in `tmpdir`.
+
+    Returns the list of stage records from `hivmmer.profile.Profile`.
+    """
+    profile = hivmmer.profile.Profile(os.path.join(tmpdir, "profile.json"))
+    prefix = os.path.join(tmpdir, "synthetic")
+    fastqs = ["{}_1.fastq".format(prefix), "{}_2.fastq".format(prefix)]
+    readfiles = hivmmer.reads.files(os.path.join(tmpdir, "deduplicated"))
+    pfafile = os.path.join(tmpdir, "translated.pfa")
+    codonfile = os.path.join(tmpdir, "codons.npz")
+    aafile = os.path.join(tmpdir, "aa.npz")
+    drmfile = os.path.join(tmpdir, "drms.csv")
+
+    with profile.stage("generate", (), fastqs) as record:
+        synthetic.generate(prefix, npairs, ref, seed)
+        record["records_out"] = 2 * npairs
+
+    with profile.stage("filter", fastqs, readfiles) as record:
+        store, record["records_in"] = hivmmer.pipeline.deduplicate(fastqs, os.path.join(tmpdir, "deduplicated"))
+        record["records_out"] = len(store)
+
+    with profile.stage("translate", readfiles, [pfafile]) as record:
+        record["records_in"] = len(store)
+        record["records_out"] = hivmmer.pipeline.translate_reads(store, pfafile, os.path.join(tmpdir, "translate.log"))
+
+    with profile.stage("hmmsearch" if hmmsearch else "hmmsearch-standin", [pfafile]) as record:
+        if hmmsearch:
+            hivmmer.copy_hmms(tmpdir)
+            record["jobs"] = []
+            alignments = hivmmer.pipeline.align(hivmmer.genes, tmpdir, pfafile, tmpdir, tmpdir, threads,
+                                                jobs=record["jobs"])
+        else:
+            alignments = synthetic.standin(pfafile, ref, tmpdir)
+        alignfiles = [path for paths in alignments.values() for path in paths]
+        record["bytes_out"] = hivmmer.profile.nbytes(alignfiles)
+
+    with profile.stage("codons", readfiles + alignfiles, [codonfile]) as record:
+        record["jobs"] = []
+        hivmmer.pipeline.extract_codons(store, alignments, processes=threads, jobs=record["jobs"]).save(codonfile)
+        record["records_out"] = sum(job["records_out"] for job in record["jobs"])
+
+    with profile.stage("consensus", [codonfile], [os.path.join(tmpdir, "consensus.fa")]):
+        hivmmer.consensus(codonfile, os.path.join(tmpdir, "consensus.fa"))
+
+    with profile.stage("aa_table", [codonfile], [aafile]):
+        hivmmer.aa_table(codonfile, aafile)
+
+    with profile.stage("drms", [aafile], [drmfile]):
+        hivmmer.drms(aafile, drmfile)
+
+    plots = [os.path.join(tmpdir, name) for name in ("coverage.pdf", "coverage-prrt.pdf", "drms.pdf", "drmi.pdf", "sdrm.pdf")]
+    with profile.stage("plots", [codonfile, aafile, drmfile], plots) as record:
+        record["jobs"] = []
+        hivmmer.report.render(codonfile, aafile, drmfile, tmpdir, processes=threads, jobs=record["jobs"])
+
+    return profile.profile["stages"]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--pairs", type=int, nargs="+", default=[10000, 100000, 1000000, 10000000],
+                        help="number of read pairs at each scale [10000 100000 1000000 10000000]")
+    parser.add_argument("-t", "--threads", type=int, default=1, help="number of threads/processes [1]")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="random seed [0]")
+    parser.add_argument("--hmmsearch", action="store_true", help="align with hmmsearch instead of the stand-in")
+    parser.add_argument("--tmpdir", help="directory for the intermediate files [system temporary directory]")
+    parser.add_argument("-o", "--output", default="benchmark.json", help="JSON results file [benchmark.json]")
+    args = parser.parse_args()
+
+    results = OrderedDict([("version", hivmmer.__version__),
+                           ("commit", commit()),
+                           ("date", time.strftime("%Y-%m-%dT%H:%M:%S%z")),
+                           ("python", platform.python_version()),
+                           ("numpy", np.__version__),
+                           ("platform", platform.platform()),
+                           ("cpus", os.cpu_count()),
+                           ("threads", args.threads),
+                           ("aligner", "hmmsearch" if args.hmmsearch else "standin"),
+                           ("seed", args.seed),
+                           ("scales", [])])
+
+    ref = synthetic.reference(args.seed)
+    print("{:>10} {:<18} {:>9} {:>9} {:>10} {:>14}".format("pairs", "stage", "wall (s)", "cpu (s)", "rss (MB)", "reads/sec"))
+    for npairs in args.pairs:
+        tmpdir = tempfile.mkdtemp(dir=args.tmpdir)
+        try:
+            stages = benchmark(npairs, ref, tmpdir, args.threads, args.hmmsearch, args.seed)
+        finally:
+            shutil.rmtree(tmpdir)
+        results["scales"].append(OrderedDict([("pairs", npairs), ("stages", stages)]))
+        for stage in stages:
+            print("{:>10} {:<18} {:>9.2f} {:>9.2f} {:>10.1f} {:>14,.0f}".format(
+                  npairs, stage["name"], stage["wall_s"], stage["cpu_s"] + stage["children_cpu_s"],
+                  stage["peak_rss_kb"] / 1024, 2 * npairs / max(stage["wall_s"], 1e-6)))
+        # Write after each scale, so that the smaller scales are kept if a
+        # larger one is interrupted
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+
+# vim: expandtab sw=4 ts=4
@@ -0,0 +1,102 @@
+"""
+Report the sensitivity of the k-mer routing prefilter (hivmmer.route)
+against an unrouted hivmmer run, by routing its translated sequences,
+searching each gene's subset with hmmsearch, and comparing the hits that
+pass the codons() score thresholds, the codon counts, and the consensus.
+
+The OUTDIR must contain an unrouted run on the same data, e.g. of
+test/5VM_1.fastq and test/5VM_2.fastq, with the default text hmmsearch
+output, which may be split into any number of chunks (-c).
+
+Usage: python route.py [-k K] [-m MIN_HITS] [-t THREADS] OUTDIR
+"""
+import argparse
+import glob
+import hivmmer
+import math
+import numpy as np
+import os
+import shutil
+import tempfile
+import time
+from hivmmer.codons import dblengths, thresholds
+
+
+def passing(hmmerfiles, gene):
+    """
+    Returns the set of (hit, domain) pairs in the hmmsearch text output
+    `hmmerfiles`, or the union over a list of outputs (one for each chunk),
+    that pass the score threshold used by `hivmmer.codons`.
+    """
+    if isinstance(hmmerfiles, str):
+        hmmerfiles = [hmmerfiles]
+    hits = set()
+    for hmmerfile in hmmerfiles:
+        for hit in hivmmer.hmmer.parse(hmmerfile):
+            if any("*" in hsp.hitseq for hsp in hit.hsps): continue
+            for hsp in hit.hsps:
+                if math.log((dblengths[gene] * hsp.hit_span) / 2**hsp.bitscore) < thresholds[gene]:
+                    hits.add((hit.id, hsp.hit_start))
+    return hits
+
+
+def chunks(alignmentdir, gene):
+    """
+    Returns the hmmsearch text outputs for `gene` in `alignmentdir`:
+    `{gene}.txt` from a run with a single chunk, otherwise `{gene}.{i}.txt`
+    for each chunk, in order.
+    """
+    single = os.path.join(alignmentdir, "{}.txt".format(gene))
+    if os.path.exists(single):
+        return [single]
+    filenames = glob.glob(os.path.join(alignmentdir, "{}.[0-9]*.txt".format(gene)))
+    assert filenames, "no hmmsearch text output for {} in {} (was the run --tabular?)".format(gene, alignmentdir)
+    return sorted(filenames, key=lambda filename: int(filename.rsplit(".", 2)[1]))
+
+
+def nseqs(pfafile):
+    with open(pfafile) as f:
+        return sum(line.startswith(">") for line in f)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-k", type=int, default=5, help="k-mer length [5]")
+    parser.add_argument("-m", "--min-hits", type=int, default=2, help="minimum number of k-mer hits [2]")
+    parser.add_argument("-t", "--threads", type=int, default=1, help="number of hmmsearch jobs [1]")
+    parser.add_argument("OUTDIR", help="output directory of an unrouted hivmmer run")
+    args = parser.parse_args()
+
+    pfafile = os.path.join(args.OUTDIR, "sequences", "translated.pfa")
+    store = hivmmer.reads.ReadStore(os.path.join(args.OUTDIR, "sequences", "deduplicated"))
+    unrouted = dict((gene, chunks(os.path.join(args.OUTDIR, "alignments"), gene)) for gene in hivmmer.genes)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        start = time.perf_counter()
+        with open(os.path.join(tmpdir, "route.log"), "w") as log:
+            subsets, total = hivmmer.route.route(pfafile, hivmmer.genes, os.path.join(tmpdir, "translated"),
+                                                 k=args.k, min_hits=args.min_hits, log=log)
+        elapsed = time.perf_counter() - start
+        hivmmer.copy_hmms(tmpdir)
+        routed = hivmmer.pipeline.align(hivmmer.genes, tmpdir, subsets, tmpdir, tmpdir, args.threads, Z=total)
+
+        print("routed {} sequences in {:.2f} s (k={}, min hits={})".format(total, elapsed, args.k, args.min_hits))
+        print("{:<5} {:>9} {:>9} {:>9} {:>9} {:>11} {:>11} {:>8}".format(
+              "gene", "searched", "unrouted", "routed", "shared", "sensitivity", "codons", "retained"))
+        counts = {}
+        for gene in hivmmer.genes:
+            a = passing(unrouted[gene], gene)
+            b = passing(routed[gene], gene)
+            counts[gene] = (hivmmer.codons(store, unrouted[gene], gene).counts[:, :64].sum(),
+                            hivmmer.codons(store, routed[gene], gene).counts[:, :64].sum())
+            print("{:<5} {:>9} {:>9} {:>9} {:>9} {:>11.4f} {:>11} {:>8.4f}".format(
+                  gene, nseqs(subsets[gene]), len(a), len(b), len(a & b), len(a & b) / max(len(a), 1),
+                  counts[gene][0], counts[gene][1] / max(counts[gene][0], 1)))
+        a, b = np.sum(list(counts.values()), axis=0)
+        print("total codons retained: {:.4f}".format(b / max(a, 1)))
+    finally:
+        shutil.rmtree(tmpdir)
+
+# vim: expandtab sw=4 ts=4
@@ -0,0 +1,141 @@
+"""
+Measure the import time of hivmmer and its modules, and the cold-start time
+of the console scripts on a tiny input, each in a fresh interpreter.
+
+`import hivmmer` and the modules behind the console scripts load pandas,
+Biopython and matplotlib only on first use. With --check, exit with status
+1 if importing any of the modules below loads one of the dependencies that
+it should not, or if `import hivmmer` exceeds the --budget, so that the
+benchmark can guard startup time in CI.
+
+Usage: python startup.py [-r REPEATS] [--check] [--budget SECONDS] [-o JSON]
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from pipeline import commit
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Each module, and the heavy dependencies that importing it must not load
+imports = OrderedDict([
+    ("hivmmer", ("Bio", "matplotlib", "pandas")),
+    ("hivmmer.filter", ("Bio", "matplotlib", "pandas")),
+    ("hivmmer.translate", ("Bio", "matplotlib", "pandas")),
+    ("hivmmer.consensus", ("matplotlib", "pandas")),
+    ("hivmmer.driver", ("Bio", "matplotlib", "pandas")),
+    ("hivmmer.pipeline", ("matplotlib", "pandas")),
+    ("hivmmer.report", ())
+])
+
+_heavy = ("Bio", "matplotlib", "pandas")
+
+
+def _entry(module, *args):
+    """
+    Returns the command line that runs the `_run` entry point of `module`
+    with arguments `args`, as its console script does.
+    """
+    return [sys.executable, "-c",
+            "import sys; sys.argv[1:] = {!r}; from {} import _run; _run()".format(list(args), module)]
+
+
+def commands(tmpdir):
+    """
+    Write a tiny FASTQ and FASTA file to `tmpdir`, and return the command line
+    of each console script to time.
+    """
+    fastq = os.path.join(tmpdir, "tiny.fastq")
+    fasta = os.path.join(tmpdir, "tiny.fa")
+    with open(os.path.join(root, "test", "5VM_1.fastq")) as f:
+        lines = [next(f) for _ in range(40)]
+    with open(fastq, "w") as f:
+        f.writelines(lines)
+    with open(fasta, "w") as f:
+        for i in range(0, len(lines), 4):
+            f.write(">{}\n{}".format(lines[i][1:].split()[0], lines[i+1]))
+    return OrderedDict([
+        ("hivmmer --version", [sys.executable, os.path.join(root, "scripts", "hivmmer"), "--version"]),
+        ("hivmmer-filter tiny.fastq", _entry("hivmmer.filter", fastq)),
+        ("hivmmer-translate tiny.fa", _entry("hivmmer.translate", fasta)),
+        ("hivmmer-consensus --help", _entry("hivmmer.consensus", "--help"))
+    ])
+
+
+def best(args, repeats):
+    """
+    Returns the best wall time of `repeats` runs of command line `args`, and
+    the standard output of the last run.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        out = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                             universal_newlines=True, check=True).stdout
+        times.append(time.perf_counter() - start)
+    return min(times), out
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-r", "--repeats", type=int, default=5, help="number of runs of each command, keeping the best [5]")
+    parser.add_argument("--check", action="store_true", help="exit with status 1 if a module loads a dependency it should not")
+    parser.add_argument("--budget", type=float, help="with --check, also fail if `import hivmmer` takes longer than this many seconds")
+    parser.add_argument("-o", "--output", default="startup.json", help="JSON results file [startup.json]")
+    args = parser.parse_args()
+
+    results = OrderedDict([("commit", commit()),
+                           ("date", time.strftime("%Y-%m-%dT%H:%M:%S%z")),
+                           ("python", platform.python_version()),
+                           ("platform", platform.platform()),
+                           ("interpreter_s", None),
+                           ("imports", []),
+                           ("commands", [])])
+    failures = []
+
+    results["interpreter_s"], _ = best([sys.executable, "-c", "pass"], args.repeats)
+    print("{:<30} {:>10}  {}".format("import", "time (s)", "loads"))
+    for module, forbidden in imports.items():
+        wall, out = best([sys.executable, "-c",
+                          "import json, sys, {}; print(json.dumps(sorted(set(m.split('.')[0] for m in sys.modules))))".format(module)],
+                         args.repeats)
+        loaded = [m for m in _heavy if m in json.loads(out)]
+        results["imports"].append(OrderedDict([("module", module), ("wall_s", round(wall, 4)), ("loads", loaded)]))
+        print("{:<30} {:>10.3f}  {}".format(module, wall, ", ".join(loaded)))
+        unexpected = [m for m in loaded if m in forbidden]
+        if unexpected:
+            failures.append("importing {} loads {}".format(module, ", ".join(unexpected)))
+        if module == "hivmmer" and args.budget is not None and wall > args.budget:
+            failures.append("importing hivmmer takes {:.3f}s, over the budget of {:.3f}s".format(wall, args.budget))
+
+    print("{:<30} {:>10}".format("command", "time (s)"))
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for name, command in commands(tmpdir).items():
+            wall, _ = best(command, args.repeats)
+            results["commands"].append(OrderedDict([("command", name), ("wall_s", round(wall, 4))]))
+            print("{:<30} {:>10.3f}".format(name, wall))
+    finally:
+        for filename in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir, filename))
+        os.rmdir(tmpdir)
+    print("{:<30} {:>10.3f}".format("(python -c pass)", results["interpreter_s"]))
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=1)
+
+    if args.check:
+        for failure in failures:
+            print("FAIL:", failure)
+        sys.exit(1 if failures else 0)
+
+# vim: expandtab sw=4 ts=4
@@ -0,0 +1,229 @@
+"""
+Generate synthetic paired-end Illumina reads of HIV-1 for benchmarks, and
+write a stand-in for the hmmsearch output of their translations.
+
+The reference genome is a back-translation of the consensus sequences of the
+prepackaged pHMMs (the `hmmaa` column of GENE.hxb2.tsv), with synonymous
+codons drawn at random, so that every translated residue aligns to a match
+state. Read pairs are sampled from fragments of the concatenated genes, with
+seeded substitution errors and N calls at a rate that increases along the
+read, and quality strings that are lower at errors and towards the 3' end.
+A fraction of reads has low overall quality, so that the filter stage drops
+them.
+
+The stand-in for hmmsearch anchors each translated sequence to the genes by
+exact amino acid k-mer matches, and writes an ungapped alignment of the
+anchored diagonal in hmmsearch text format, which `hivmmer.codons` reads the
+same way as real hmmsearch output. It runs in a fraction of the time of
+hmmsearch, so the Python stages can be benchmarked at scales where
+hmmsearch would dominate.
+
+Usage: python synthetic.py [-n PAIRS] [-s SEED] PREFIX
+       writes PREFIX_1.fastq and PREFIX_2.fastq
+"""
+import argparse
+import hivmmer
+import numpy as np
+import os
+from Bio.Data.CodonTable import unambiguous_dna_by_id
+from collections import OrderedDict, namedtuple
+from hivmmer.route import encode
+from hivmmer.translate import read_fasta
+
+Reference = namedtuple("Reference", ["genes", "hmmseqs", "proteins", "genome", "starts"])
+Reference.__doc__ = """
+The synthetic genome: the concatenated back-translation `genome` of the
+`proteins` of each gene in `genes`, with the nucleotide offset of each gene
+in `starts`, and the pHMM consensus `hmmseqs` that the proteins align to.
+"""
+
+_nts = np.frombuffer(b"ACGT", dtype=np.uint8)
+_complement = np.zeros(256, dtype=np.uint8)
+for a, b in zip(b"ACGTN", b"TGCAN"):
+    _complement[a] = b
+
+
+def reference(seed=0):
+    """
+    Back-translate the pHMM consensus sequence of each gene, drawing one of
+    the synonymous codons of each residue at random.
+    """
+    rng = np.random.RandomState(seed)
+    codons = {}
+    for codon, aa in sorted(unambiguous_dna_by_id[1].forward_table.items()):
+        codons.setdefault(aa, []).append(codon)
+    hmmseqs = []
+    proteins = []
+    genome = []
+    starts = []
+    offset = 0
+    for gene in hivmmer.genes:
+        states = hivmmer.data.table("{}.hxb2".format(gene))
+        # Consecutive states that map to a single HXB2 position (del > 0)
+        # list the residues of all of them in `hmmaa`
+        hmmseq = "".join(aa[len(aa) - 1 - d] for aa, d in zip(states["hmmaa"].tolist(), states["del"].tolist()))
+        hmmseqs.append(hmmseq)
+        proteins.append(hmmseq.upper())
+        genome.append("".join(codons[aa][rng.randint(len(codons[aa]))] for aa in proteins[-1]))
+        starts.append(offset)
+        offset += len(genome[-1])
+    return Reference(hivmmer.genes, hmmseqs, proteins, "".join(genome), starts)
+
+
+def _write_fastq(f, reads, quals, first, mate):
+    seqs = reads.tobytes()
+    quals = quals.tobytes()
+    n = reads.shape[1]
+    f.write(b"".join(b"@synthetic.%d/%d\n%s\n+\n%s\n" % (first + i, mate, seqs[i*n:(i+1)*n], quals[i*n:(i+1)*n])
+                     for i in range(reads.shape[0])))
+
+
+def generate(prefix, npairs, ref=None, seed=0, length=150, fragment=(200, 500),
+             error_rate=0.002, n_rate=0.0002, low_quality=0.05, batchsize=100000):
+    """
+    Write `npairs` read pairs of `length` sampled from fragments of the
+    synthetic genome `ref` to `{prefix}_1.fastq` and `{prefix}_2.fastq`.
+
+    Returns the two file names.
+    """
+    if ref is None:
+        ref = reference(seed)
+    rng = np.random.RandomState(seed)
+    genome = np.frombuffer(ref.genome.encode("ascii"), dtype=np.uint8)
+    positions = np.arange(length)
+    # Error rates and quality scores degrade along the read
+    decay = 1 + 2 * positions / length
+    filenames = ("{}_1.fastq".format(prefix), "{}_2.fastq".format(prefix))
+    with open(filenames[0], "wb") as f1, open(filenames[1], "wb") as f2:
+        for first in range(0, npairs, batchsize):
+            n = min(batchsize, npairs - first)
+            sizes = rng.randint(fragment[0], fragment[1] + 1, size=n)
+            starts = rng.randint(0, len(genome) - sizes + 1)
+            for mate, f, offsets in ((1, f1, starts), (2, f2, starts + sizes - length)):
+                reads = genome[offsets[:, None] + positions]
+                if mate == 2:
+                    reads = _complement[reads[:, ::-1]]
+                quals = rng.normal(36, 3, size=reads.shape) - 8 * positions / length
+                quals[rng.rand(n) < low_quality] -= 15
+                errors = rng.rand(*reads.shape) < error_rate * decay
+                codes = np.searchsorted(_nts, reads[errors])
+                reads[errors] = _nts[(codes + rng.randint(1, 4, size=len(codes))) % 4]
+                quals[errors] = rng.randint(5, 20, size=errors.sum())
+                ns = rng.rand(*reads.shape) < n_rate * decay
+                reads[ns] = ord("N")
+                quals[ns] = 2
+                quals = np.clip(np.rint(quals), 2, 41).astype(np.uint8) + 33
+                _write_fastq(f, reads, quals, first, mate)
+    return filenames
+
+
+def _kmer_index(ref, k):
+    """
+    Returns the sorted distinct amino acid k-mers of the reference proteins,
+    with the gene and position of the first occurrence of each.
+    """
+    kmers, offsets = encode(ref.proteins, k)
+    counts = np.diff(offsets)
+    genes = np.repeat(np.arange(len(ref.genes)), counts)
+    positions = np.arange(len(kmers)) - np.repeat(offsets[:-1], counts)
+    keep = kmers > 0
+    kmers, index = np.unique(kmers[keep], return_index=True)
+    return kmers, genes[keep][index], positions[keep][index]
+
+
+def _write_header(f, gene, length):
+    print("# hmmsearch :: search profile(s) against a sequence database", file=f)
+    print("# stand-in written by benchmark/synthetic.py", file=f)
+    print("Query:       {}  [M={}]".format(gene, length), file=f)
+    print("Scores for complete sequences (score includes all domains):", file=f)
+    print("   --- full sequence ---   --- best 1 domain ---    -#dom-", file=f)
+    print("    E-value  score  bias    E-value  score  bias    exp  N  Sequence Description", file=f)
+    print("    ------- ------ -----    ------- ------ -----   ---- --  -------- -----------", file=f)
+    print("", file=f)
+    print("Domain annotation for each sequence (and alignments):", file=f)
+
+
+def _format_hit(gene, id, hmmfrom, alifrom, hmmseq, hitseq):
+    span = len(hitseq)
+    score = 3.0 * span
+    return (">> {id}\n"
+            "   #    score  bias  c-Evalue  i-Evalue hmmfrom  hmm to    alifrom  ali to    envfrom  env to     acc\n"
+            " ---   ------ ----- --------- --------- ------- -------    ------- -------    ------- -------    ----\n"
+            "   1 ! {score:6.1f}   0.0   1.0e-30   1.0e-30 {hmmfrom:7d} {hmmto:7d} .. {alifrom:7d} {alito:7d} .. {alifrom:7d} {alito:7d} ..  0.99\n"
+            "\n"
+            "  Alignments for each domain:\n"
+            "  == domain 1  score: {score:.1f} bits;  conditional E-value: 1e-30\n"
+            "  {gene} {hmmfrom} {hmmseq} {hmmto}\n"
+            "  {match}\n"
+            "  {id} {alifrom} {hitseq} {alito}\n"
+            "  {pp} PP\n"
+            "\n").format(id=id, gene=gene, score=score,
+                         hmmfrom=hmmfrom, hmmto=hmmfrom + span - 1, hmmseq=hmmseq,
+                         alifrom=alifrom, alito=alifrom + span - 1, hitseq=hitseq,
+                         match="+" * span, pp="*" * span)
+
+
+def standin(pfafile, ref, outdir, k=6, batchsize=100000):
+    """
+    Write a stand-in for the hmmsearch text output of the translated
+    sequences in `pfafile` against each gene in `ref` to
+    `{outdir}/{gene}.txt`.
+
+    Each translated sequence is anchored to a gene at its first exact k-mer
+    match with the gene's protein, and aligned without gaps along that
+    diagonal, clipped to the ends of the protein.
+
+    Returns an ordered dictionary mapping each gene to a list of its single
+    output file, as `hivmmer.pipeline.align` does for a single chunk.
+    """
+    kmers, genes, positions = _kmer_index(ref, k)
+    ngenes = len(ref.genes)
+    alignments = OrderedDict((gene, [os.path.join(outdir, "{}.txt".format(gene))]) for gene in ref.genes)
+    files = [open(paths[0], "w") for paths in alignments.values()]
+    try:
+        for f, gene, protein in zip(files, ref.genes, ref.proteins):
+            _write_header(f, gene, len(protein))
+        for batch in read_fasta(pfafile, batchsize):
+            seqs = [seq for _, seq in batch]
+            query, offsets = encode(seqs, k)
+            counts = np.diff(offsets)
+            frames = np.repeat(np.arange(len(seqs)), counts)
+            index = np.minimum(np.searchsorted(kmers, query), len(kmers) - 1)
+            found = (query > 0) & (kmers[index] == query)
+            # First anchor of each sequence in each gene
+            keys, first = np.unique(frames[found] * ngenes + genes[index[found]], return_index=True)
+            at = np.flatnonzero(found)[first]
+            diagonals = positions[index[at]] - (at - offsets[frames[at]])
+            lines = [[] for _ in range(ngenes)]
+            for key, diagonal in zip(keys.tolist(), diagonals.tolist()):
+                i, g = divmod(key, ngenes)
+                id, seq = batch[i]
+                start = max(0, -diagonal)
+                end = min(len(seq), len(ref.proteins[g]) - diagonal)
+                if end - start < k:
+                    continue
+                lines[g].append(_format_hit(ref.genes[g], id, diagonal + start + 1, start + 1,
+                                            ref.hmmseqs[g][diagonal+start:diagonal+end], seq[start:end]))
+            for f, hits in zip(files, lines):
+                f.write("".join(hits))
+        for f in files:
+            print("Internal pipeline statistics summary:", file=f)
+            print("//", file=f)
+    finally:
+        for f in files:
+            f.close()
+    return alignments
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--pairs", type=int, default=10000, help="number of read pairs [10000]")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="random seed [0]")
+    parser.add_argument("PREFIX", help="prefix of the FASTQ files")
+    args = parser.parse_args()
+
+    for filename in generate(args.PREFIX, args.pairs, seed=args.seed):
+        print(filename)
+
+# vim: expandtab sw=4 ts=4
@@ -11,17 +11,53 @@ deep Illumina sequencing of HIV. Bioinformatics 35(12): 2029-2035.
 doi:10.1093/bioinformatics/bty919
 """
 
+import importlib
 import os
-import pandas as pd
+import sys
+import types
 from importlib import resources
 
-import hivmmer.filter
-import hivmmer.report
-from .codons import codons
-from .consensus import consensus
-from .drms import drms
-from .table import aa_table
-from .translate import translate, translate_unambiguous
+# Submodules are imported on first use, so that the console scripts and
+# `import hivmmer` don't pay for pandas, Biopython and matplotlib unless they
+# need them (see benchmark/startup.py).
+_submodules = ("codons", "consensus", "counts", "data", "driver", "drms", "fastq", "filter", "hmmer",
+               "manifest", "pipeline", "profile", "reads", "report", "route", "table", "translate")
+
+# Functions re-exported from submodules, several under the submodule's name
+_functions = {
+    "aa_table": "table",
+    "codons": "codons",
+    "consensus": "consensus",
+    "drms": "drms",
+    "translate": "translate",
+    "translate_unambiguous": "translate"
+}
+
+def __getattr__(name):
+    if name in _functions:
+        value = getattr(importlib.import_module("." + _functions[name], __name__), name)
+    elif name in _submodules:
+        value = importlib.import_module("." + name, __name__)
+    else:
+        raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_submodules) | set(_functions))
+
+class _Package(types.ModuleType):
+    """
+    The import system binds each submodule to the package once it is loaded,
+    which would replace the functions re-exported under the same name (such
+    as `hivmmer.consensus`) with their submodules.
+    """
+    def __setattr__(self, name, value):
+        if name in _functions and isinstance(value, types.ModuleType):
+            return
+        super().__setattr__(name, value)
+
+sys.modules[__name__].__class__ = _Package
 
 __version__ = resources.read_text("hivmmer", "VERSION").strip()
 
@@ -42,10 +78,10 @@ def list_hxb2():
     """
     Returns the ordered list of HXB2 coordinates in the prepackaged HMM files.
     """
+    from . import data
     hxb2 = []
     for gene in genes:
-        with resources.open_binary("hivmmer", "{}.hxb2.tsv".format(gene)) as f:
-            hxb2 += pd.read_csv(f, sep="\t", usecols=["hxb2"]).hxb2.tolist()
+        hxb2 += data.table("{}.hxb2".format(gene))["hxb2"].tolist()
     return hxb2
 
 # vim: expandtab sw=4 ts=4
@@ -1,13 +1,15 @@
 """
 """
 import math
-import pandas as pd
-import sys
-from Bio import SearchIO
+import os
 from Bio import Seq
-from Bio import SeqIO
-from importlib import resources
-from itertools import chain
+from Bio.Data import CodonTable
+from . import data
+from . import hmmer
+from . import reads
+from .counts import AMBIGUOUS, DELETION, CodonCounts, columns, ncolumns
+from itertools import product
+from multiprocessing import Pool
 
 # For more information on how thresholds were estimated,
 # see `validation/README.md` in the hivmmer git repo.
@@ -33,120 +35,344 @@ dblengths = {
     "vpu": 53*4573
 }
 
+# Alignment files smaller than this are not worth splitting across processes.
+_min_shard_size = 1 << 20
+
 def _load_hxb2(gene):
     """
     Load a pre-computed index that converts HMM position to
     HXB2 coordinates for `gene`.
     """
-    with resources.open_binary("hivmmer", "{}.hxb2.tsv".format(gene)) as f:
-        return pd.read_csv(f, sep="\t", usecols=["hmm", "hxb2", "ins", "del"], index_col="hmm")
+    return data.frame("{}.hxb2".format(gene))[["hmm", "hxb2", "ins", "del"]].set_index("hmm")
+
+def _translation_table():
+    """
+    Precompute the amino acid for each of the 64 unambiguous codons.
+    """
+    table = CodonTable.unambiguous_dna_by_id[1]
+    translation = {}
+    for codon in map("".join, product("TCAG", repeat=3)):
+        translation[codon] = table.forward_table.get(codon, "*")
+    return translation
+
+translation = _translation_table()
+
+class _IndexedFasta(object):
+    """
+    Random-access lookup of reads in a FASTA file, with the same `sequence`
+    interface as `hivmmer.reads.ReadStore`.
+    """
+
+    def __init__(self, readfile):
+        from Bio import SeqIO
+        self.index = SeqIO.index(readfile, "fasta")
+
+    def sequence(self, id):
+        return str(self.index[id].seq)
+
+def _open_reads(readfile):
+    """
+    Open `readfile` as a `hivmmer.reads.ReadStore` if it is a store or the
+    prefix of a packed read store, or otherwise index it as a FASTA file.
+    """
+    if isinstance(readfile, reads.ReadStore):
+        return readfile
+    elif reads.exists(readfile):
+        return reads.ReadStore(readfile)
+    else:
+        return _IndexedFasta(readfile)
+
+def _read_hits(hmmerfile):
+    """
+    Read all hits in `hmmerfile` into memory with Biopython SearchIO.
+    """
+    from Bio import SearchIO
+    for hit in SearchIO.read(hmmerfile, "hmmer3-text").hits:
+        yield hmmer.Hit(hit.id, [hmmer.HSP(hsp.bitscore, hsp.query_start, hsp.hit_start, hsp.hit_span,
+                                           str(hsp.aln[0].seq), str(hsp.aln[1].seq))
+                                 for hsp in hit.hsps])
+
+def _count_pandas(tally, coords, seq, offset, count, hsp):
+    """
+    Reference implementation of the alignment walker, which looks up
+    HXB2 coordinates for each aligned residue in the `coords` data frame.
+    """
+    first, table, extra = tally
+    i    = 0                         # tracks position in the alignment (0-indexed)
+    hmm  = hsp.query_start + 1       # tracks position in the HMM reference sequence (1-indexed)
+    read = 3*hsp.hit_start + offset  # tracks position in the read sequence (0-indexed)
 
-def codons(readfile, hmmerfile, gene):
+    # read/reference sequences should have same length in alignment
+    n = len(hsp.hmmseq)
+    assert len(hsp.hitseq) == n
+
+    # alignment should not start or end with an insertion
+    assert hsp.hmmseq[0] != "."
+    assert hsp.hmmseq[n-1] != "."
+
+    while i < n:
+
+        aa_frame = []
+        codon_frame = []
+        hxb2 = coords.loc[hmm, "hxb2"]
+
+        aa = hsp.hitseq[i]
+        if aa != "-":
+            aa_frame.append(aa)
+            codon_frame.append(seq[read:read+3])
+            read += 3
+
+        # Extend frame with insertions relative to HMM
+        while i < (n-1) and hsp.hmmseq[i+1] == ".":
+            aa_frame.append(hsp.hitseq[i+1])
+            codon_frame.append(seq[read:read+3])
+            assert aa_frame[-1] != "-"
+            read += 3
+            i += 1
+
+        # Extend frame with deletions relative to HXB2
+        for _ in range(coords.loc[hmm, "del"]):
+
+            if i < (n-1):
+                aa = hsp.hitseq[i+1]
+                if aa != "-":
+                    aa_frame.append(aa)
+                    codon_frame.append(seq[read:read+3])
+                    read += 3
+                    i += 1
+                    hmm += 1
+
+            while i < (n-1) and hsp.hmmseq[i+1] == ".":
+                aa_frame.append(hsp.hitseq[i+1])
+                codon_frame.append(seq[read:read+3])
+                assert aa_frame[-1] != "-"
+                read += 3
+                i += 1
+
+        # Assign codons, adjusting coordinates relative to HXB2 insertions
+        assert len(aa_frame) == len(codon_frame)
+        for _ in range(coords.loc[hmm, "ins"] + 1):
+            row = (hxb2 - first) // 3
+            # Iterate through the codon frame
+            if codon_frame:
+                codon = codon_frame.pop(0)
+                aa = aa_frame.pop(0)
+                if aa != 'X' and 'N' not in codon:
+                    assert str(Seq.translate(codon)) == aa.upper()
+                    if codon in columns:
+                        table[row*ncolumns + columns[codon]] += count
+                    else:
+                        extra[(row, codon)] = extra.get((row, codon), 0) + count
+                else:
+                    table[row*ncolumns + AMBIGUOUS] += count
+            # Deletions occur when the codon frame is empty
+            else:
+                table[row*ncolumns + DELETION] += count
+            hxb2 += 3
+
+        i += 1
+        hmm += 1
+
+def _count_array(tally, index, seq, offset, count, hsp):
     """
+    Array-indexed implementation of the alignment walker, which looks up
+    HXB2 coordinates in the flat `index` lists from `hivmmer.data.hxb2_index` and
+    checks translations against the precomputed codon table.
+    """
+    first, table, extra = tally
+    hxb2s, inss, dels = index
+    ref = hsp.hmmseq
+    aln = hsp.hitseq
+
+    i    = 0                         # tracks position in the alignment (0-indexed)
+    hmm  = hsp.query_start + 1       # tracks position in the HMM reference sequence (1-indexed)
+    read = 3*hsp.hit_start + offset  # tracks position in the read sequence (0-indexed)
+
+    # read/reference sequences should have same length in alignment
+    n = len(ref)
+    assert len(aln) == n
+
+    # alignment should not start or end with an insertion
+    assert ref[0] != "."
+    assert ref[n-1] != "."
+
+    while i < n:
+
+        aa_frame = []
+        codon_frame = []
+        hxb2 = hxb2s[hmm]
+
+        aa = aln[i]
+        if aa != "-":
+            aa_frame.append(aa)
+            codon_frame.append(seq[read:read+3])
+            read += 3
+
+        # Extend frame with insertions relative to HMM
+        while i < (n-1) and ref[i+1] == ".":
+            aa_frame.append(aln[i+1])
+            codon_frame.append(seq[read:read+3])
+            assert aa_frame[-1] != "-"
+            read += 3
+            i += 1
+
+        # Extend frame with deletions relative to HXB2
+        for _ in range(dels[hmm]):
+
+            if i < (n-1):
+                aa = aln[i+1]
+                if aa != "-":
+                    aa_frame.append(aa)
+                    codon_frame.append(seq[read:read+3])
+                    read += 3
+                    i += 1
+                    hmm += 1
+
+            while i < (n-1) and ref[i+1] == ".":
+                aa_frame.append(aln[i+1])
+                codon_frame.append(seq[read:read+3])
+                assert aa_frame[-1] != "-"
+                read += 3
+                i += 1
+
+        # Assign codons, adjusting coordinates relative to HXB2 insertions
+        assert len(aa_frame) == len(codon_frame)
+        j = 0
+        for _ in range(inss[hmm] + 1):
+            k = (hxb2 - first) // 3 * ncolumns
+            # Iterate through the codon frame
+            if j < len(codon_frame):
+                codon = codon_frame[j]
+                aa = aa_frame[j]
+                j += 1
+                if aa != 'X' and 'N' not in codon:
+                    translated = translation.get(codon)
+                    if translated is None:
+                        translated = str(Seq.translate(codon))
+                    assert translated == aa.upper()
+                    column = columns.get(codon)
+                    if column is None:
+                        key = (k // ncolumns, codon)
+                        extra[key] = extra.get(key, 0) + count
+                    else:
+                        table[k + column] += count
+                else:
+                    table[k + AMBIGUOUS] += count
+            # Deletions occur when the codon frame is empty
+            else:
+                table[k + DELETION] += count
+            hxb2 += 3
+
+        i += 1
+        hmm += 1
+
+def count(readfile, hmmerfile, gene, start=0, end=None, engine="array", stream=True):
+    """
+    Count codons at each HXB2 position for `gene` from the hits in
+    `hmmerfile` that begin within the byte range [`start`, `end`).
+
+    Returns a `hivmmer.counts.CodonCounts` table.
+    See `codons` for a description of the arguments.
     """
 
     dblength  = dblengths[gene]
     threshold = thresholds[gene]
-    coords    = _load_hxb2(gene)
 
-    reads = SeqIO.index(readfile, "fasta")
-    hmmer = SearchIO.read(hmmerfile, "hmmer3-text")
+    if engine == "array":
+        walk   = _count_array
+        coords = tuple(a.tolist() for a in data.hxb2_index(gene))
+        first, last = coords[0][1], coords[0][-1]
+    elif engine == "pandas":
+        walk   = _count_pandas
+        coords = _load_hxb2(gene)
+        first, last = coords.hxb2.iloc[0], coords.hxb2.iloc[-1]
+    else:
+        raise ValueError("unknown codons engine '{}'".format(engine))
+
+    if isinstance(hmmerfile, tuple):
+        hits = hmmer.parse_tabular(*hmmerfile)
+    elif stream:
+        hits = hmmer.parse(hmmerfile, start, end)
+    elif start == 0 and end is None:
+        hits = _read_hits(hmmerfile)
+    else:
+        raise ValueError("byte ranges of hmmerfile require stream=True")
+
+    store = _open_reads(readfile)
 
-    counts = dict((hxb2, {}) for hxb2 in range(coords.hxb2.iloc[0], coords.hxb2.iloc[-1] + 1, 3))
+    hxb2  = range(first, last + 1, 3)
+    tally = (first, [0] * (len(hxb2) * ncolumns), {})
 
-    for hit in hmmer.hits:
+    for hit in hits:
 
         # Skip hits that contain stop codons (indicates wrong frame)
-        if "*" in chain(hsp.aln[1].seq for hsp in hit.hsps): continue
+        if any("*" in hsp.hitseq for hsp in hit.hsps): continue
 
         id, _, frame = hit.id.rpartition("-")
-        count = int(id.partition("-")[2])
+        n = int(id.partition("-")[2])
 
         if frame.endswith("'"):
-            seq = str(reads[id].seq.reverse_complement())
+            seq = Seq.reverse_complement(store.sequence(id))
             offset = int(frame[:-1])
         else:
-            seq = str(reads[id].seq)
+            seq = store.sequence(id)
             offset = int(frame)
 
         for hsp in hit.hsps:
 
             if math.log((dblength * hsp.hit_span) / 2**hsp.bitscore) >= threshold: continue
 
-            i    = 0                         # tracks position in the alignment (0-indexed)
-            hmm  = hsp.query_start + 1       # tracks position in the HMM reference sequence (1-indexed)
-            read = 3*hsp.hit_start + offset  # tracks position in the read sequence (0-indexed)
+            walk(tally, coords, seq, offset, n, hsp)
 
-            # read/reference sequences should have same length in alignment
-            n = len(hsp.aln[0].seq)
-            assert len(hsp.aln[1].seq) == n
+    return CodonCounts(hxb2, tally[1], tally[2])
 
-            # alignment should not start or end with an insertion
-            assert hsp.aln[0].seq[0] != "."
-            assert hsp.aln[0].seq[n-1] != "."
+def codons(readfile, hmmerfile, gene, engine="array", stream=True, processes=1):
+    """
+    Extract codon counts at each HXB2 position for `gene` from the
+    hmmsearch alignments in `hmmerfile` of the translated reads in
+    `readfile`, which is either a FASTA file or the prefix of a packed read
+    store written by `hivmmer.reads.write`.
 
-            while i < n:
+    `hmmerfile` is either hmmsearch text output, or a (`--domtblout`, `-A`)
+    pair of a domain table and Stockholm alignment (see
+    `hivmmer.hmmer.parse_tabular`), or a list of either for chunks of the
+    translated reads (see `hivmmer.pipeline.align`), which are counted as
+    separate shards.
 
-                aa_frame = []
-                codon_frame = []
-                hxb2 = coords.loc[hmm, "hxb2"]
+    `engine` selects the alignment walker: "array" uses flat integer
+    indexes and a precomputed codon table, while "pandas" is the original
+    per-residue data frame lookup, kept as a reference for comparison.
 
-                aa = hsp.aln[1].seq[i]
-                if aa != "-":
-                    aa_frame.append(aa)
-                    codon_frame.append(seq[read:read+3])
-                    read += 3
+    If `stream` is true, hits are parsed and counted one at a time, so that
+    peak memory depends on the size of the count table rather than the size
+    of `hmmerfile`. Otherwise, the whole file is read with Biopython SearchIO.
 
-                # Extend frame with insertions relative to HMM
-                while i < (n-1) and hsp.aln[0].seq[i+1] == ".":
-                    aa_frame.append(hsp.aln[1].seq[i+1])
-                    codon_frame.append(seq[read:read+3])
-                    assert aa_frame[-1] != "-"
-                    read += 3
-                    i += 1
+    If `processes` > 1, each hmmsearch text output is split at hit
+    boundaries into shards, and the shards are counted in a process pool
+    and then merged.
 
-                # Extend frame with deletions relative to HXB2
-                for _ in range(coords.loc[hmm, "del"]):
-
-                    if i < (n-1):
-                        aa = hsp.aln[1].seq[i+1]
-                        if aa != "-":
-                            aa_frame.append(aa)
-                            codon_frame.append(seq[read:read+3])
-                            read += 3
-                            i += 1
-                            hmm += 1
-
-                    while i < (n-1) and hsp.aln[0].seq[i+1] == ".":
-                        aa_frame.append(hsp.aln[1].seq[i+1])
-                        codon_frame.append(seq[read:read+3])
-                        assert aa_frame[-1] != "-"
-                        read += 3
-                        i += 1
-
-                # Assign codons, adjusting coordinates relative to HXB2 insertions
-                assert len(aa_frame) == len(codon_frame)
-                for _ in range(coords.loc[hmm, "ins"] + 1):
-                    # Iterate through the codon frame
-                    if codon_frame:
-                        codon = codon_frame.pop(0)
-                        aa = aa_frame.pop(0)
-                        if aa != 'X' and 'N' not in codon:
-                            assert str(Seq.translate(codon)) == aa.upper()
-                            counts[hxb2][codon] = counts[hxb2].get(codon, 0) + count
-                    # Deletions occur when the codon frame is empty
-                    else:
-                        counts[hxb2][""] = counts[hxb2].get("", 0) + count
-                    hxb2 += 3
+    Returns a `hivmmer.counts.CodonCounts` table.
+    """
 
-                i += 1
-                hmm += 1
-
-    # output
-    lines = []
-    for hxb2 in sorted(counts):
-        for codon in sorted(counts[hxb2], key=counts[hxb2].get, reverse=True):
-            lines.append("\t".join([str(hxb2), codon, str(counts[hxb2][codon])]))
-    return lines
+    shards = []
+    for output in (hmmerfile if isinstance(hmmerfile, list) else [hmmerfile]):
+        if processes > 1 and stream and not isinstance(output, tuple):
+            nshards = max(1, min(processes, os.path.getsize(output) // _min_shard_size))
+            shards.extend((output, start, end) for start, end in hmmer.split(output, nshards))
+        else:
+            shards.append((output, 0, None))
+
+    if len(shards) > 1 and processes > 1:
+        # Build the HXB2 index before forking, so the workers share it
+        if engine == "array":
+            data.hxb2_index(gene)
+        with Pool(processes=min(processes, len(shards))) as pool:
+            return CodonCounts.merge(pool.starmap(count, [(readfile, shard, gene, start, end, engine, stream)
+                                                          for shard, start, end in shards]))
+    elif len(shards) > 1:
+        return CodonCounts.merge([count(readfile, shard, gene, start, end, engine, stream)
+                                  for shard, start, end in shards])
+    else:
+        return count(readfile, shards[0][0], gene, engine=engine, stream=stream)
 
 # vim: expandtab sw=4 ts=4
@@ -3,43 +3,123 @@
 
 import argparse
 import hivmmer
-import pandas as pd
-from Bio import Seq
+import numpy as np
+from Bio.Data import IUPACData
+from hivmmer import counts
 
-_ambiguous = dict(("".join(sorted(b)), a) for a, b in Seq.IUPAC.IUPACData.ambiguous_dna_values.items())
+_ambiguous = dict(("".join(sorted(b)), a) for a, b in IUPACData.ambiguous_dna_values.items())
 _frequencies = [0.01, 0.02, 0.05, 0.1, 0.15, 0.2, 0.25, 0.4]
 
-def consensus(codonfile, outfile, min_coverage=1000):
+def _iupac_tables():
     """
-    Write FASTA `outfile` with consensus sequences at varying
-    thresholds, using only the variants above `min_coverage`.
+    Encode nucleotides (including IUPAC ambiguity codes) as 4-bit masks of
+    A, C, G and T, so that the ambiguity code of a set of nucleotides is a
+    lookup of the OR of their masks.
+
+    Returns the mask of each byte, and the IUPAC code of each mask.
+    """
+    bits = dict(zip("ACGT", (1, 2, 4, 8)))
+    masks = np.full(256, 15, dtype=np.uint8)
+    for code, nts in IUPACData.ambiguous_dna_values.items():
+        masks[ord(code)] = sum(bits[nt] for nt in set(nts))
+    codes = np.zeros(16, dtype=np.uint8)
+    for nts, code in _ambiguous.items():
+        codes[sum(bits[nt] for nt in nts)] = ord(code)
+    return masks, codes
+
+_masks, _codes = _iupac_tables()
+
+def _codon_masks(codons, width):
+    """
+    Returns the length of each codon string in `codons` and a matrix of the
+    nucleotide masks at each of its first `width` positions.
+    """
+    lengths = np.fromiter(map(len, codons), dtype=np.int64, count=len(codons))
+    masks = np.zeros((len(codons), width), dtype=np.uint8)
+    for i, codon in enumerate(codons):
+        masks[i, :len(codon)] = _masks[np.frombuffer(codon.encode("ascii"), dtype=np.uint8)]
+    return lengths, masks
+
+def consensus_sequences(codons, frequencies=_frequencies, min_coverage=1000):
     """
-    codons = pd.read_csv(codonfile, sep="\t", index_col="hxb2").fillna("")
+    Build a consensus sequence from the `hivmmer.counts.CodonCounts` table
+    `codons` for each threshold in `frequencies`, using only the sites with
+    coverage of at least `min_coverage`.
 
-    # Sum counts by site
-    sums = codons.groupby(level=0)["count"].sum()
-    sums = sums.to_frame(name="sum")
-    codons = codons.join(sums, how="left")
+    At each HXB2 position in `hivmmer.list_hxb2()`, the consensus is the
+    IUPAC code of the nucleotides of every codon with frequency at or above
+    the threshold, or "---" if there is none. Each codon passes a prefix of
+    the sorted thresholds, so the nucleotide masks and codon lengths are
+    accumulated for each site and number of passed thresholds, and then
+    combined across thresholds with one cumulative OR (and minimum), rather
+    than by filtering the table once for each threshold.
 
-    # Filter out low-coverage sites
-    codons = codons[codons["sum"] >= min_coverage]
+    Returns a list of the consensus sequences, in the order of `frequencies`.
+    """
+    # Every codon with a nonzero count, as (row, count, length, masks)
+    rows, columns = np.nonzero(codons.counts[:, :counts.AMBIGUOUS])
+    labels = list(counts.codons) + [""]
+    extra = sorted(codons.extra.items())
+    width = max([3] + [len(codon) for (_, codon), _ in extra])
+    lengths, masks = _codon_masks(labels, width)
+    rows = np.concatenate((rows, np.array([row for (row, _), _ in extra], dtype=np.int64)))
+    n = np.concatenate((codons.counts[rows[:len(columns)], columns],
+                        np.array([count for _, count in extra], dtype=np.int64)))
+    extra_lengths, extra_masks = _codon_masks([codon for (_, codon), _ in extra], width)
+    lengths = np.concatenate((lengths[columns], extra_lengths))
+    masks = np.concatenate((masks[columns], extra_masks))
+
+    # Coverage of each site, summed over the rows with the same HXB2 position
+    hxb2, sites = np.unique(codons.hxb2, return_inverse=True)
+    if len(hxb2) == 0:
+        return ["" for _ in frequencies]
+    sites = sites[rows]
+    coverage = np.bincount(sites, weights=n, minlength=len(hxb2))
+    frequency = n * (1.0 / coverage[sites])
+
+    # The number of (sorted) thresholds that each codon passes
+    thresholds = np.sort(np.asarray(frequencies, dtype=np.float64))
+    passed = np.searchsorted(thresholds, frequency, side="right")
+    passed[coverage[sites] < min_coverage] = 0
 
-    # Normalize counts
-    codons["frequency"] = codons["count"] * (1.0 / codons["sum"])
+    nthresholds = len(thresholds)
+    site_masks = np.zeros((nthresholds + 1, len(hxb2), width), dtype=np.uint8)
+    site_lengths = np.full((nthresholds + 1, len(hxb2)), width + 1, dtype=np.int64)
+    np.bitwise_or.at(site_masks, (passed, sites), masks)
+    np.minimum.at(site_lengths, (passed, sites), lengths)
+    # A codon that passes k thresholds is included at thresholds 0..k-1
+    site_masks = np.bitwise_or.accumulate(site_masks[::-1], axis=0)[::-1][1:]
+    site_lengths = np.minimum.accumulate(site_lengths[::-1], axis=0)[::-1][1:]
 
-    hxb2 = hivmmer.list_hxb2()
+    # Assemble the sequences in the order of the HXB2 positions of the HMMs
+    order = np.asarray(hivmmer.list_hxb2(), dtype=np.int64)
+    index = np.minimum(np.searchsorted(hxb2, order), len(hxb2) - 1)
+    known = hxb2[index] == order
+    gap = np.zeros(width, dtype=np.uint8)
+    gap[:3] = ord("-")
+    sequences = []
+    for t in np.searchsorted(thresholds, frequencies).tolist():
+        present = known & (site_lengths[t, index] <= width)
+        chars = np.where(present[:, None], _codes[site_masks[t, index]], gap)
+        length = np.where(present, site_lengths[t, index], 3)
+        seq = chars[np.arange(width) < length[:, None]].tobytes().decode("ascii")
+        sequences.append(seq.strip("-"))
+    return sequences
+
+def consensus(codonfile, outfile, min_coverage=1000, frequencies=None):
+    """
+    Write FASTA `outfile` with consensus sequences at varying
+    thresholds, using only the variants above `min_coverage`.
+
+    `frequencies` is a list of thresholds, by default `_frequencies`.
+    """
+    if frequencies is None:
+        frequencies = _frequencies
+    sequences = consensus_sequences(counts.read(codonfile), frequencies, min_coverage)
     with open(outfile, "w") as f:
-        for freq in _frequencies:
-            codons = codons[codons["frequency"] >= freq]
+        for freq, seq in zip(frequencies, sequences):
             print(">{}".format(freq), file=f)
-            seq = []
-            for i in hxb2:
-                if not i in codons.index:
-                    seq.append("---")
-                else:
-                    for nt in zip(*codons.loc[[i], "codon"].tolist()):
-                        seq.append(_ambiguous["".join(sorted(set(nt)))])
-            print("".join(seq).strip("-"), file=f)
+            print(seq, file=f)
 
 def _run():
 
@@ -49,12 +129,18 @@ def _run():
                         metavar="N",
                         type=int,
                         help="minimum coverage for sites included in the consensus (default: 1000)")
+    parser.add_argument("-f", "--frequencies",
+                        default=_frequencies,
+                        metavar="F",
+                        nargs="+",
+                        type=float,
+                        help="frequency thresholds, one consensus sequence each (default: {})".format(" ".join(map(str, _frequencies))))
     parser.add_argument("CODONS",
-                        help="input tab-separated file with codon frequencies")
+                        help="input codon counts, as a .npz or tab-separated file")
     parser.add_argument("FASTA",
                         help="output FASTA file with consensus sequences")
     args = parser.parse_args()
 
-    consensus(args.CODONS, args.FASTA, args.min_coverage)
+    consensus(args.CODONS, args.FASTA, args.min_coverage, args.frequencies)
 
 # vim: expandtab sw=4 ts=4
@@ -0,0 +1,169 @@
+"""
+"""
+import numpy as np
+from itertools import product
+
+# Column layout of the count matrix: the 64 unambiguous codons in
+# lexicographic order, then deletions and ambiguous codons (containing
+# an N or translating to X), which are not written to TSV output.
+codons = tuple(map("".join, product("ACGT", repeat=3)))
+columns = dict((codon, i) for i, codon in enumerate(codons))
+DELETION = 64
+AMBIGUOUS = 65
+ncolumns = 66
+
+class CodonCounts(object):
+    """
+    Dense table of codon counts with one row per HXB2 position in `hxb2`.
+
+    `counts` is an integer matrix with one column for each of the 64 codons,
+    plus the `DELETION` and `AMBIGUOUS` columns. Any other codon strings,
+    such as insertions longer than three nucleotides or codons with IUPAC
+    ambiguity codes, are kept in the sparse side table `extra`, keyed by
+    (row, codon).
+    """
+
+    def __init__(self, hxb2, counts=None, extra=None):
+        self.hxb2 = np.asarray(hxb2, dtype=np.int64)
+        if counts is None:
+            counts = np.zeros((len(self.hxb2), ncolumns), dtype=np.int64)
+        self.counts = np.asarray(counts, dtype=np.int64).reshape(len(self.hxb2), ncolumns)
+        self.extra = {} if extra is None else extra
+
+    def __len__(self):
+        return len(self.hxb2)
+
+    @classmethod
+    def merge(cls, shards):
+        """
+        Sum a list of count tables that cover the same HXB2 positions.
+        """
+        merged = cls(shards[0].hxb2)
+        for shard in shards:
+            assert np.array_equal(shard.hxb2, merged.hxb2)
+            merged.counts += shard.counts
+            for key, n in shard.extra.items():
+                merged.extra[key] = merged.extra.get(key, 0) + n
+        return merged
+
+    @classmethod
+    def concat(cls, tables):
+        """
+        Stack a list of count tables, e.g. for each gene, into a single table.
+        """
+        extra = {}
+        offset = 0
+        for table in tables:
+            for (row, codon), n in table.extra.items():
+                extra[(row + offset, codon)] = n
+            offset += len(table)
+        return cls(np.concatenate([table.hxb2 for table in tables]),
+                   np.concatenate([table.counts for table in tables]),
+                   extra)
+
+    def save(self, filename):
+        """
+        Write the count table to NumPy .npz file `filename`.
+        """
+        keys = sorted(self.extra)
+        np.savez_compressed(filename,
+                            hxb2=self.hxb2,
+                            counts=self.counts,
+                            extra_row=np.array([row for row, _ in keys], dtype=np.int64),
+                            extra_codon=np.array([codon for _, codon in keys], dtype=np.str_),
+                            extra_count=np.array([self.extra[key] for key in keys], dtype=np.int64))
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Read a count table from NumPy .npz file `filename`.
+        """
+        with np.load(filename) as npz:
+            extra = dict(((row, codon), n) for row, codon, n in zip(npz["extra_row"].tolist(),
+                                                                      npz["extra_codon"].tolist(),
+                                                                      npz["extra_count"].tolist()))
+            return cls(npz["hxb2"], npz["counts"], extra)
+
+    def lines(self):
+        """
+        Returns a list of tab-separated lines with HXB2 position, codon and
+        count, listing the codons at each position by decreasing count.
+        """
+        labels = codons + ("",)
+        extra = {}
+        for (row, codon), n in self.extra.items():
+            extra.setdefault(row, []).append((codon, n))
+        lines = []
+        for row, (hxb2, counts) in enumerate(zip(self.hxb2.tolist(), self.counts[:, :AMBIGUOUS].tolist())):
+            site = [(codon, n) for codon, n in zip(labels, counts) if n > 0]
+            site += sorted(extra.get(row, []))
+            site.sort(key=lambda item: item[1], reverse=True)
+            for codon, n in site:
+                lines.append("\t".join([str(hxb2), codon, str(n)]))
+        return lines
+
+    def write_tsv(self, f):
+        """
+        Write the count table to tab-separated file `f`.
+        """
+        print("hxb2", "codon", "count", sep="\t", file=f)
+        for line in self.lines():
+            print(line, file=f)
+
+    def to_frame(self):
+        """
+        Returns a data frame of codon counts indexed by HXB2 position, in the
+        same format as reading the TSV output with `read_frame`.
+        """
+        import pandas as pd
+        rows, cols = np.nonzero(self.counts[:, :AMBIGUOUS])
+        labels = np.array(codons + ("",), dtype=object)
+        frame = pd.DataFrame({"hxb2": self.hxb2[rows],
+                              "codon": labels[cols],
+                              "count": self.counts[rows, cols]})
+        if self.extra:
+            keys = sorted(self.extra)
+            frame = pd.concat([frame, pd.DataFrame({"hxb2": self.hxb2[[row for row, _ in keys]],
+                                                    "codon": [codon for _, codon in keys],
+                                                    "count": [self.extra[key] for key in keys]})])
+        return frame.sort_values("hxb2", kind="stable").set_index("hxb2")
+
+def read(filename):
+    """
+    Read a `CodonCounts` table from either a NumPy .npz file or a
+    tab-separated codons file.
+    """
+    if filename.endswith(".npz"):
+        return CodonCounts.load(filename)
+    hxb2 = []
+    rows = []
+    extra = {}
+    with open(filename) as f:
+        assert next(f).rstrip("\n").split("\t") == ["hxb2", "codon", "count"]
+        for line in f:
+            position, codon, n = line.rstrip("\n").split("\t")
+            position = int(position)
+            # A new row starts whenever the position changes, so that genes
+            # that overlap in HXB2 coordinates keep separate rows
+            if not hxb2 or hxb2[-1] != position:
+                hxb2.append(position)
+                rows.append([0] * ncolumns)
+            if codon == "":
+                rows[-1][DELETION] += int(n)
+            elif codon in columns:
+                rows[-1][columns[codon]] += int(n)
+            else:
+                extra[(len(hxb2) - 1, codon)] = int(n)
+    return CodonCounts(hxb2, np.array(rows, dtype=np.int64).reshape(len(hxb2), ncolumns), extra)
+
+def read_frame(filename):
+    """
+    Read codon counts from either a NumPy .npz file or a tab-separated codons
+    file into a data frame indexed by HXB2 position.
+    """
+    if filename.endswith(".npz"):
+        return CodonCounts.load(filename).to_frame()
+    import pandas as pd
+    return pd.read_csv(filename, sep="\t", index_col="hxb2").fillna("")
+
+# vim: expandtab sw=4 ts=4
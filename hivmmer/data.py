@@ -0,0 +1,162 @@
+"""
+Registry of the prepackaged reference tables: the map from HMM positions to
+HXB2 coordinates of each gene (`GENE.hxb2.tsv`, as table "GENE.hxb2") and
+the list of IAS and Stanford DRMs (`drms.csv`, as table "drms").
+
+Each table is loaded at most once per process and cached as read-only NumPy
+arrays, as is the HMM-to-HXB2 index built from each gene's table (see
+`hxb2_index`), which pool workers forked after loading share with their
+parent (see `preload`). Tables are loaded from the precompiled archive `data.npz`
+in the package when its copy of the table is up to date with the source
+file, and are otherwise parsed from the source file.
+
+Rebuild the archive after editing a source table with:
+
+    python -c "import hivmmer.data; hivmmer.data.compile()"
+"""
+import hashlib
+import hivmmer
+import io
+import numpy as np
+import os
+from collections import OrderedDict
+from importlib import resources
+
+_archive = "data.npz"
+
+# Cached tables and HXB2 indexes, and the open archive (False if it is not
+# packaged)
+_tables = {}
+_indexes = {}
+_npz = None
+
+def sources():
+    """
+    Returns an ordered dictionary mapping the name of each table to its
+    packaged source file.
+    """
+    tables = OrderedDict(("{}.hxb2".format(gene), "{}.hxb2.tsv".format(gene)) for gene in hivmmer.genes)
+    tables["drms"] = "drms.csv"
+    return tables
+
+def _parse(data, filename):
+    """
+    Parse the source file `filename`, with contents `data`, into an ordered
+    dictionary of column arrays. Missing values are NaN in numeric columns,
+    as `pd.read_csv` parses them, and empty strings in string columns, since
+    NumPy unicode arrays cannot hold NaN.
+    """
+    import pandas as pd
+    frame = pd.read_csv(io.BytesIO(data), sep="\t" if filename.endswith(".tsv") else ",")
+    columns = OrderedDict()
+    for column in frame.columns:
+        if pd.api.types.is_numeric_dtype(frame[column]):
+            columns[column] = frame[column].to_numpy()
+        else:
+            columns[column] = np.array(frame[column].fillna("").tolist(), dtype=np.str_)
+    return columns
+
+def _digest(data):
+    return hashlib.sha1(data).hexdigest()
+
+def _open_archive():
+    global _npz
+    if _npz is None:
+        try:
+            with resources.open_binary("hivmmer", _archive) as f:
+                with np.load(f) as npz:
+                    _npz = dict((key, npz[key]) for key in npz.files)
+        except (OSError, ValueError):
+            _npz = False
+    return _npz
+
+def _load(name):
+    filename = sources()[name]
+    data = resources.read_binary("hivmmer", filename)
+    npz = _open_archive()
+    digest = "{}.digest".format(name)
+    if npz and digest in npz and str(npz[digest]) == _digest(data):
+        records = npz[name]
+        return OrderedDict((column, records[column]) for column in records.dtype.names)
+    return _parse(data, filename)
+
+def table(name):
+    """
+    Returns the table `name` as an ordered dictionary of read-only column
+    arrays, with strings as NumPy unicode arrays. Missing values are NaN in
+    numeric columns and empty strings in string columns.
+    """
+    columns = _tables.get(name)
+    if columns is None:
+        if name not in sources():
+            raise ValueError("unknown reference table '{}'".format(name))
+        columns = _load(name)
+        for array in columns.values():
+            array.flags.writeable = False
+        _tables[name] = columns
+    return columns
+
+def frame(name):
+    """
+    Returns a new data frame with a copy of the table `name`, with strings
+    as Python objects and missing values as NaN, as `pd.read_csv` returns
+    them.
+    """
+    import pandas as pd
+    return pd.DataFrame(OrderedDict((column, np.where(array == "", np.nan, array.astype(object))
+                                             if array.dtype.kind == "U" else array.copy())
+                                    for column, array in table(name).items()))
+
+def hxb2_index(gene):
+    """
+    Returns the map from HMM positions to HXB2 coordinates of `gene` (table
+    "GENE.hxb2") flattened into a read-only integer array with rows of HXB2
+    coordinates, insertions and deletions, indexed directly by the
+    (1-indexed) HMM position.
+    """
+    index = _indexes.get(gene)
+    if index is None:
+        coords = table("{}.hxb2".format(gene))
+        index = np.zeros((3, coords["hmm"].max() + 1), dtype=np.int64)
+        index[0, coords["hmm"]] = coords["hxb2"]
+        index[1, coords["hmm"]] = coords["ins"]
+        index[2, coords["hmm"]] = coords["del"]
+        index.flags.writeable = False
+        _indexes[gene] = index
+    return index
+
+def preload():
+    """
+    Load every table and HXB2 index, for instance before forking a pool of
+    workers that will use them.
+    """
+    for name in sources():
+        table(name)
+    for gene in hivmmer.genes:
+        hxb2_index(gene)
+
+def compile(outfile=None):
+    """
+    Parse every source table and write them, with the digest of each source
+    file, to the archive `outfile` (by default, `data.npz` in the package).
+
+    Each table is stored as a single structured array, since loading an
+    archive member costs more than loading its contents.
+    """
+    if outfile is None:
+        outfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), _archive)
+    arrays = {}
+    for name, filename in sources().items():
+        data = resources.read_binary("hivmmer", filename)
+        columns = _parse(data, filename)
+        records = np.empty(len(next(iter(columns.values()))),
+                           dtype=[(column, array.dtype) for column, array in columns.items()])
+        for column, array in columns.items():
+            records[column] = array
+        arrays[name] = records
+        arrays["{}.digest".format(name)] = np.array(_digest(data), dtype=np.str_)
+    with open(outfile, "wb") as f:
+        np.savez_compressed(f, **arrays)
+    return outfile
+
+# vim: expandtab sw=4 ts=4
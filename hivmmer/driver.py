@@ -0,0 +1,405 @@
+"""
+Run the whole hivmmer pipeline on one sample, or on a batch of samples from a
+sample sheet.
+
+A batch runs its samples concurrently in a process pool, sharing a single
+CPU budget: with `threads` in total and `jobs` samples at a time, each
+sample gets `threads // jobs` threads for PEAR, hmmsearch and codon
+extraction. The pool workers are forked from the process that has already
+imported hivmmer and its dependencies and loaded the reference tables (see
+`hivmmer.data`), and the pHMM references are copied once for the whole
+batch.
+"""
+import csv
+import hivmmer
+import json
+import os
+import sys
+import time
+import traceback
+from argparse import Namespace
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout
+
+
+def run(fastq1, fastq2, outdir, args, hmmdir=None):
+    """
+    Run every stage of the pipeline on the paired reads in `fastq1` and
+    `fastq2`, writing the results to `outdir`, with the options `args`
+    parsed by the `hivmmer` script.
+
+    Each stage records a manifest of its inputs, parameters and outputs in
+    `logs/manifests`, and is skipped if they are unchanged since the last
+    run in `outdir`, unless `args.force` is set. The resource usage of each
+    stage is written to `logs/profile.json`.
+
+    If `hmmdir` is not None, the pHMMs are read from that directory, which
+    `hivmmer.copy_hmms` has already populated, instead of being copied to
+    `{outdir}/references`.
+    """
+    fastq1 = os.path.abspath(fastq1)
+    fastq2 = os.path.abspath(fastq2)
+    if hmmdir is not None:
+        hmmdir = os.path.abspath(hmmdir)
+    cwd = os.getcwd()
+    try:
+        _run(fastq1, fastq2, outdir, args, hmmdir)
+    finally:
+        os.chdir(cwd)
+
+
+def _run(fastq1, fastq2, outdir, args, hmmdir):
+
+    print("Creating output directories in:")
+    print(os.path.abspath(outdir))
+    os.makedirs(outdir, exist_ok=True)
+    os.chdir(outdir)
+    os.makedirs("logs", exist_ok=True)
+    os.makedirs("sequences", exist_ok=True)
+    os.makedirs("alignments", exist_ok=True)
+    os.makedirs("report", exist_ok=True)
+
+    profile = hivmmer.profile.Profile("logs/profile.json", "logs/profile" if args.profile else None)
+
+    def stale(stage, record):
+        """
+        Test whether `stage` has to be run, and if so, invalidate its
+        manifest until it has finished.
+        """
+        if args.force or not stage.fresh():
+            stage.invalidate()
+            return True
+        print("Skipping: inputs, parameters and version are unchanged")
+        record["skipped"] = True
+        return False
+
+    pearfiles = hivmmer.pipeline.pearfiles("sequences/pear")
+    readfiles = hivmmer.reads.files("sequences/deduplicated")
+    fasta = "sequences/deduplicated.fa" if args.debug else None
+    memory = None if args.memory is None else args.memory * 1048576
+    if args.stream:
+        print("Running PEAR on FASTQ inputs, and filtering and deduplicating its output as it is written:")
+        print(fastq1)
+        print(fastq2)
+        outputs = readfiles + ([fasta] if args.debug else []) + (pearfiles if args.keep_pear else [])
+        stage = hivmmer.manifest.Stage("pear-filter", [fastq1, fastq2],
+                                       {"min_length": args.min_length, "min_quality": args.min_quality,
+                                        "debug": args.debug, "keep_pear": args.keep_pear})
+        with profile.stage("pear-filter", [fastq1, fastq2], outputs) as record:
+            if stale(stage, record):
+                record["jobs"] = []
+                store, _ = hivmmer.pipeline.stream_deduplicate(fastq1,
+                                                               fastq2,
+                                                               "sequences/deduplicated",
+                                                               "logs/pear.log",
+                                                               args.min_length,
+                                                               args.min_quality,
+                                                               args.threads,
+                                                               memory=memory,
+                                                               tmpdir="sequences",
+                                                               fasta=fasta,
+                                                               keep="sequences/pear" if args.keep_pear else None,
+                                                               jobs=record["jobs"])
+                stage.record(outputs)
+                counts = hivmmer.pipeline.pear_counts("logs/pear.log")
+                if counts is not None:
+                    record["records_in"] = counts[0]
+                record["records_out"] = len(store)
+            else:
+                store = hivmmer.reads.ReadStore("sequences/deduplicated")
+    else:
+        print("Running PEAR on FASTQ inputs:")
+        print(fastq1)
+        print(fastq2)
+        stage = hivmmer.manifest.Stage("pear", [fastq1, fastq2])
+        with profile.stage("pear", [fastq1, fastq2], pearfiles) as record:
+            if stale(stage, record):
+                usage = hivmmer.pipeline.pear(fastq1, fastq2, "sequences/pear", "logs/pear.log", args.threads)
+                stage.record(pearfiles)
+                counts = hivmmer.pipeline.pear_counts("logs/pear.log")
+                if counts is not None:
+                    record["records_in"], record["records_out"] = counts
+                record["jobs"] = [dict(name="pear", **usage)]
+
+        print("Filtering and deduplicating PEAR sequences")
+        stage = hivmmer.manifest.Stage("filter", pearfiles,
+                                       {"min_length": args.min_length, "min_quality": args.min_quality, "debug": args.debug})
+        with profile.stage("filter", pearfiles, readfiles) as record:
+            if stale(stage, record):
+                store, nreads = hivmmer.pipeline.deduplicate(pearfiles,
+                                                             "sequences/deduplicated",
+                                                             args.min_length,
+                                                             args.min_quality,
+                                                             memory=memory,
+                                                             tmpdir="sequences",
+                                                             fasta=fasta)
+                stage.record(readfiles + ([fasta] if args.debug else []))
+                record["records_in"] = nreads
+                record["records_out"] = len(store)
+            else:
+                store = hivmmer.reads.ReadStore("sequences/deduplicated")
+
+    print("Translating deduplicated sequences to amino acid sequences")
+    stage = hivmmer.manifest.Stage("translate", readfiles, {"max_stops": args.max_stops})
+    with profile.stage("translate", readfiles, ["sequences/translated.pfa"]) as record:
+        if stale(stage, record):
+            record["records_in"] = len(store)
+            record["records_out"] = hivmmer.pipeline.translate_reads(store, "sequences/translated.pfa", "logs/translate.log", args.max_stops)
+            stage.record(["sequences/translated.pfa", "logs/translate.log"])
+
+    if hmmdir is None:
+        print("Copying pHMM references")
+        hmmdir = "references"
+        os.makedirs(hmmdir, exist_ok=True)
+        hivmmer.copy_hmms(hmmdir)
+
+    if args.route:
+        print("Routing translated sequences to genes")
+        stage = hivmmer.manifest.Stage("route", ["sequences/translated.pfa"])
+        with profile.stage("route", ["sequences/translated.pfa"]) as record:
+            if stale(stage, record):
+                with open("logs/route.log", "w") as log:
+                    databases, nseqs = hivmmer.route.route("sequences/translated.pfa", hivmmer.genes, "sequences/translated", log=log)
+                stage.record(list(databases.values()) + ["logs/route.log"], [databases, nseqs])
+                record["records_in"] = nseqs
+                record["bytes_out"] = hivmmer.profile.nbytes(databases.values())
+            else:
+                databases, nseqs = stage.result
+    else:
+        databases, nseqs = "sequences/translated.pfa", None
+
+    print("Aligning {} with hmmsearch".format(", ".join(hivmmer.genes)))
+    hmmfiles = [os.path.join(hmmdir, "{}.hmm.{}".format(gene, ext))
+                for gene in hivmmer.genes for ext in ("h3f", "h3i", "h3m", "h3p")]
+    stage = hivmmer.manifest.Stage("hmmsearch",
+                                   sorted(set(databases.values() if args.route else [databases])) + hmmfiles,
+                                   {"chunks": args.chunks or args.threads, "Z": nseqs, "tabular": args.tabular})
+    with profile.stage("hmmsearch", stage.inputs) as record:
+        if stale(stage, record):
+            record["jobs"] = []
+            alignments = hivmmer.pipeline.align(hivmmer.genes,
+                                                hmmdir,
+                                                databases,
+                                                "alignments",
+                                                "logs",
+                                                args.threads,
+                                                args.chunks,
+                                                nseqs,
+                                                tabular=args.tabular,
+                                                jobs=record["jobs"])
+            if args.tabular:
+                alignfiles = [path for pairs in alignments.values() for pair in pairs for path in pair]
+            else:
+                alignfiles = [path for paths in alignments.values() for path in paths]
+            stage.record(alignfiles, alignments)
+        else:
+            alignments = stage.result
+            if args.tabular:
+                # JSON has no tuples, but codons() expects (domtbl, sto) pairs
+                alignments = dict((gene, [tuple(pair) for pair in pairs]) for gene, pairs in alignments.items())
+            alignments = OrderedDict((gene, alignments[gene]) for gene in hivmmer.genes)
+            alignfiles = list(stage.manifest["outputs"])
+        record["bytes_out"] = hivmmer.profile.nbytes(alignfiles)
+
+    print("Extracting codons from hmmsearch alignments")
+    codonfiles = ["codons.npz"] + (["codons.tsv"] if args.tsv else [])
+    stage = hivmmer.manifest.Stage("codons", readfiles + alignfiles, {"tsv": args.tsv})
+    with profile.stage("codons", readfiles + alignfiles, codonfiles) as record:
+        if stale(stage, record):
+            record["jobs"] = []
+            codons = hivmmer.pipeline.extract_codons(store, alignments, processes=args.threads, jobs=record["jobs"])
+            codons.save("codons.npz")
+            if args.tsv:
+                with open("codons.tsv", "w") as f:
+                    codons.write_tsv(f)
+            stage.record(codonfiles)
+            record["records_out"] = sum(job["records_out"] for job in record["jobs"])
+
+    print("Generating consensus sequences")
+    stage = hivmmer.manifest.Stage("consensus", ["codons.npz"], {"frequencies": args.frequencies})
+    with profile.stage("consensus", ["codons.npz"], ["consensus.fa"]) as record:
+        if stale(stage, record):
+            hivmmer.consensus("codons.npz", "consensus.fa", frequencies=args.frequencies)
+            stage.record(["consensus.fa"])
+
+    print("Generating AA table")
+    stage = hivmmer.manifest.Stage("aa_table", ["codons.npz"], {"xlsx": args.xlsx})
+    aafiles = ["aa.npz"] + (["aa.xlsx"] if args.xlsx else [])
+    with profile.stage("aa_table", ["codons.npz"], aafiles) as record:
+        if stale(stage, record):
+            hivmmer.aa_table("codons.npz", "aa.npz")
+            if args.xlsx:
+                hivmmer.table.write(hivmmer.table.read_frame("aa.npz"), "aa.xlsx")
+            stage.record(aafiles)
+
+    print("Identifying DRMs in AA table")
+    stage = hivmmer.manifest.Stage("drms", ["aa.npz"])
+    with profile.stage("drms", ["aa.npz"], ["drms.csv"]) as record:
+        if stale(stage, record):
+            hivmmer.drms("aa.npz", "drms.csv")
+            stage.record(["drms.csv"])
+
+    print("Plotting coverage and DRMs/SDRMs")
+    report_start = time.perf_counter()
+    plots = ["report/coverage.pdf", "report/coverage-prrt.pdf", "report/drms.pdf", "report/drmi.pdf", "report/sdrm.pdf"]
+    stage = hivmmer.manifest.Stage("plots", ["codons.npz", "aa.npz", "drms.csv"])
+    with profile.stage("plots", stage.inputs, plots) as record:
+        if stale(stage, record):
+            record["jobs"] = []
+            drms, drmi, sdrm = hivmmer.report.render("codons.npz", "aa.npz", "drms.csv", "report",
+                                                     processes=args.threads, jobs=record["jobs"])
+            stage.record(plots, [drms, drmi, sdrm])
+        else:
+            drms, drmi, sdrm = stage.result
+
+    print("Compiling PDF report with {}".format(args.report_backend))
+    # The matplotlib report backend draws the plots directly onto its pages
+    if args.report_backend == "matplotlib":
+        inputs = ["codons.npz", "aa.npz", "drms.csv"]
+    else:
+        inputs = plots
+    stage = hivmmer.manifest.Stage("report", inputs, {"fastq": [fastq1, fastq2], "backend": args.report_backend})
+    with profile.stage("report", inputs, ["report.pdf"]) as record:
+        if stale(stage, record):
+            if args.report_backend == "matplotlib":
+                hivmmer.report.assemble([fastq1, fastq2], "codons.npz", "aa.npz", "drms.csv", "report.pdf")
+            else:
+                hivmmer.report.compile([fastq1, fastq2],
+                                       "coverage.pdf", "coverage-prrt.pdf",
+                                       "drms.pdf", "drmi.pdf", "sdrm.pdf",
+                                       drms, drmi, sdrm,
+                                       "report", "report.pdf")
+            stage.record(["report.pdf"])
+    print("Plotted and compiled the report in {:.1f}s".format(time.perf_counter() - report_start))
+
+
+def read_sheet(filename):
+    """
+    Read a sample sheet: a tab- or comma-separated file with a header line
+    and the columns `sample`, `fastq1` and `fastq2`. Relative FASTQ paths
+    are relative to the directory of the sample sheet.
+
+    Returns a list of (sample, fastq1, fastq2) tuples.
+    """
+    dirname = os.path.dirname(os.path.abspath(filename))
+    with open(filename, newline="") as f:
+        lines = [line for line in f if line.strip() and not line.startswith("#")]
+    assert lines, "ERROR: sample sheet {} is empty".format(filename)
+    delimiter = "\t" if "\t" in lines[0] else ","
+    samples = []
+    for row in csv.DictReader(lines, delimiter=delimiter):
+        missing = [column for column in ("sample", "fastq1", "fastq2") if not row.get(column)]
+        if missing:
+            raise ValueError("sample sheet {} is missing {} in row: {}".format(filename, ", ".join(missing), row))
+        samples.append((row["sample"].strip(),
+                        os.path.join(dirname, row["fastq1"].strip()),
+                        os.path.join(dirname, row["fastq2"].strip())))
+    names = [sample for sample, _, _ in samples]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        raise ValueError("sample sheet {} has duplicate samples: {}".format(filename, ", ".join(duplicates)))
+    for name in names:
+        if os.path.basename(name) != name or name in (".", ".."):
+            raise ValueError("sample name '{}' is not a valid directory name".format(name))
+    return samples
+
+
+_summary = [("reads", "pear", "records_in"),
+            ("merged", "pear", "records_out"),
+            ("deduplicated", "filter", "records_out"),
+            ("frames", "translate", "records_out"),
+            ("codons", "codons", "records_out")]
+
+
+def _run_sample(sample, fastq1, fastq2, outdir, args, hmmdir):
+    """
+    Run one sample of a batch in `outdir`, with its console output in
+    `{outdir}/logs/hivmmer.log`, and return its row of the batch summary.
+    Errors are logged and reported in the summary rather than raised, so
+    that the rest of the batch continues.
+    """
+    start = time.time()
+    os.makedirs(os.path.join(outdir, "logs"), exist_ok=True)
+    status = "ok"
+    error = ""
+    with open(os.path.join(outdir, "logs", "hivmmer.log"), "w") as log, redirect_stdout(log):
+        try:
+            run(fastq1, fastq2, outdir, args, hmmdir)
+            print("Finished.")
+        except Exception as e:
+            traceback.print_exc(file=log)
+            status = "failed"
+            error = "{}: {}".format(type(e).__name__, e).splitlines()[0]
+    summary = OrderedDict([("sample", sample),
+                           ("status", status),
+                           ("wall_s", round(time.time() - start, 3)),
+                           ("outdir", os.path.abspath(outdir))])
+    try:
+        with open(os.path.join(outdir, "logs", "profile.json")) as f:
+            stages = dict((stage["name"], stage) for stage in json.load(f)["stages"])
+    except (OSError, ValueError):
+        stages = {}
+    if "pear-filter" in stages:
+        # With --stream, PEAR and the filter run as one stage, which records
+        # the number of reads that PEAR wrote in its PEAR job
+        stream = stages["pear-filter"]
+        stages["pear"] = {"records_in": stream.get("records_in", ""),
+                          "records_out": (stream.get("jobs") or [{}])[0].get("records_out", "")}
+        stages["filter"] = stream
+    for column, name, key in _summary:
+        summary[column] = stages.get(name, {}).get(key, "")
+    summary["error"] = error
+    return summary
+
+
+def batch(sheet, outdir, args, jobs=None):
+    """
+    Run the pipeline on each sample in the sample sheet `sheet` (see
+    `read_sheet`) in `{outdir}/{sample}`, with up to `jobs` samples at a
+    time (by default, as many as `args.threads` allows) and `args.threads`
+    threads in total.
+
+    Writes a summary of the batch, with the status, wall time, read counts
+    and any error of each sample, to `{outdir}/batch.tsv`, and returns it.
+    """
+    samples = read_sheet(sheet)
+    if jobs is None:
+        jobs = min(args.threads, len(samples))
+    jobs = max(1, min(jobs, len(samples)))
+    threads = max(1, args.threads // jobs)
+    if jobs > args.threads:
+        print("WARNING: running {} samples at a time exceeds --threads {}".format(jobs, args.threads))
+    sample_args = Namespace(**vars(args))
+    sample_args.threads = threads
+
+    print("Running {} samples, {} at a time with {} threads each, in:".format(len(samples), jobs, threads))
+    print(os.path.abspath(outdir))
+    hmmdir = os.path.join(outdir, "references")
+    os.makedirs(hmmdir, exist_ok=True)
+    print("Copying pHMM references")
+    hivmmer.copy_hmms(hmmdir)
+    # Load the reference tables before forking, so the workers share them
+    hivmmer.data.preload()
+    sys.stdout.flush()
+
+    summaries = {}
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = dict((executor.submit(_run_sample, sample, fastq1, fastq2,
+                                        os.path.join(outdir, sample), sample_args, hmmdir), sample)
+                       for sample, fastq1, fastq2 in samples)
+        for future in as_completed(futures):
+            summary = future.result()
+            summaries[summary["sample"]] = summary
+            print("{}: {} in {:.1f}s{}".format(summary["sample"], summary["status"], summary["wall_s"],
+                                               " ({})".format(summary["error"]) if summary["error"] else ""))
+            sys.stdout.flush()
+
+    summaries = [summaries[sample] for sample, _, _ in samples]
+    with open(os.path.join(outdir, "batch.tsv"), "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(summaries[0]), delimiter="\t", lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(summaries)
+    return summaries
+
+# vim: expandtab sw=4 ts=4
@@ -1,20 +1,19 @@
 """
 """
-import pandas as pd
-from importlib import resources
+from hivmmer import data
+from hivmmer.table import read_frame
 
 def _load_drm_list():
     """
     Load a pre-packaged list of IAS and Stanford DRMs.
     """
-    with resources.open_binary("hivmmer", "drms.csv") as f:
-        return pd.read_csv(f)
+    return data.frame("drms")
 
 def drms(aafile, outfile, coverage=10, frequency=0.01):
     """
     """
     # Load the AA table
-    aa = pd.read_excel(aafile)
+    aa = read_frame(aafile)
     del aa["hxb2"]
 
     # Unpivot and remove zero- or low-coverage calls
@@ -0,0 +1,84 @@
+"""
+"""
+import gzip
+import numpy as np
+from contextlib import ExitStack, contextmanager
+
+_phred_offset = 33
+
+@contextmanager
+def _open(filename):
+    """
+    Open `filename` for binary reading, decompressing it on the fly if it
+    starts with the gzip magic number. `filename` can also be a buffered
+    binary file object that is already open, such as the read end of a pipe,
+    which is left open for the caller to close.
+    """
+    with ExitStack() as stack:
+        f = filename
+        if isinstance(filename, str):
+            f = stack.enter_context(open(filename, "rb"))
+        if f.peek(2)[:2] == b"\x1f\x8b":
+            # GzipFile does not close a file object that it is given
+            f = stack.enter_context(gzip.GzipFile(fileobj=f, mode="rb"))
+        yield f
+
+class Batch(object):
+    """
+    A batch of FASTQ records, with the sequences and quality strings of all
+    records packed into contiguous `seqs` and `quals` byte arrays. Record `i`
+    occupies the range `starts[i]:ends[i]` in both arrays.
+    """
+
+    def __init__(self, seqs, quals):
+        lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+        if not np.array_equal(lengths, np.fromiter(map(len, quals), dtype=np.int64, count=len(quals))):
+            raise ValueError("FASTQ sequence and quality lengths differ")
+        self.lengths = lengths
+        self.ends = np.cumsum(lengths)
+        self.starts = self.ends - lengths
+        self.seqs = np.frombuffer(b"".join(seqs), dtype=np.uint8)
+        self.quals = np.frombuffer(b"".join(quals), dtype=np.uint8).astype(np.int64) - _phred_offset
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def sequence(self, i):
+        """
+        Return the sequence of record `i` as a string.
+        """
+        return self.seqs[self.starts[i]:self.ends[i]].tobytes().decode("ascii")
+
+    def mean_quality(self):
+        """
+        Return the mean PHRED quality score of each record.
+        """
+        totals = np.concatenate(([0], np.cumsum(self.quals)))
+        sums = totals[self.ends] - totals[self.starts]
+        return np.divide(sums, self.lengths, out=np.zeros(len(self), dtype=np.float64), where=self.lengths > 0)
+
+def read(filename, chunksize=1 << 24):
+    """
+    Read the four-line FASTQ records in `filename`, which may be gzipped or
+    an open binary file (see `_open`), in chunks of about `chunksize` bytes.
+
+    Yields a `Batch` for each chunk of records.
+    """
+    name = getattr(filename, "name", filename)
+    with _open(filename) as f:
+        while True:
+            lines = f.readlines(chunksize)
+            # Read until the chunk ends at a record boundary
+            while len(lines) % 4:
+                line = f.readline()
+                if not line:
+                    raise ValueError("truncated FASTQ record in {}".format(name))
+                lines.append(line)
+            if not lines:
+                break
+            if not all(header[:1] == b"@" for header in lines[0::4]):
+                raise ValueError("malformed FASTQ record in {}".format(name))
+            yield Batch([line.rstrip() for line in lines[1::4]],
+                        [line.rstrip() for line in lines[3::4]])
+
+# vim: expandtab sw=4 ts=4
@@ -1,46 +1,68 @@
 import argparse
+import heapq
+import numpy as np
+import os
+import shutil
 import sys
-from Bio import SeqIO
+import tempfile
+import zlib
+from hivmmer import fastq
 from operator import itemgetter
 
 
 def mean_filter(filename, min_length, min_quality, keep={}):
     """
-    Filters out Illumina reads in input FASTA file `filename` with
+    Filters out Illumina reads in input FASTQ file `filename` with
     length < `min_length` and mean quality score < `min_quality`.
 
     Deduplicates identical sequences.
 
     Adds distinct sequences to dictionary `keep`, with the sequence
     count as the value.
+
+    Returns the number of records read.
     """
-    for seq in SeqIO.parse(filename, "fastq"):
-        if len(seq) > min_length and sum(seq.letter_annotations["phred_quality"]) / len(seq) > min_quality:
-            seq = str(seq.seq)
+    nrecords = 0
+    for batch in fastq.read(filename):
+        nrecords += len(batch)
+        passed = (batch.lengths > min_length) & (batch.mean_quality() > min_quality)
+        seqs = batch.seqs.tobytes().decode("ascii")
+        for start, end in zip(batch.starts[passed].tolist(), batch.ends[passed].tolist()):
+            seq = seqs[start:end]
             keep[seq] = keep.get(seq, 0) + 1
+    return nrecords
 
 
 def split_filter(filename, min_length, min_quality, keep={}):
     """
-    Split reads in input FASTA file `filename` into subsequences with
+    Split reads in input FASTQ file `filename` into subsequences with
     quality score > `min_quality` and length > `min_length`.
 
     Deduplicates identical subsequences.
 
     Adds distinct subsequences to dictionary `keep`, with the subsequence
     count as the value.
+
+    Returns the number of records read.
     """
-    for seq in SeqIO.parse(filename, "fastq"):
-        quality = seq.letter_annotations["phred_quality"]
-        seq = str(seq.seq)
-        start = 0
-        i = 0
-        for i, (nt, q) in enumerate(zip(seq, quality)):
-            if nt == 'N' or q < min_quality:
-                subseq = seq[start:i+1]
-                if len(subseq) > min_length:
-                    keep[subseq] = keep.get(subseq, 0) + 1
-                start = i
+    nrecords = 0
+    for batch in fastq.read(filename):
+        nrecords += len(batch)
+        seqs = batch.seqs.tobytes().decode("ascii")
+        # Locate the low-quality or N bases that end each subsequence
+        breaks = np.flatnonzero((batch.seqs == ord("N")) | (batch.quals < min_quality))
+        reads = np.searchsorted(batch.ends, breaks, side="right")
+        starts = batch.starts.tolist()
+        current = -1
+        for read, i in zip(reads.tolist(), breaks.tolist()):
+            if read != current:
+                current = read
+                start = starts[read]
+            subseq = seqs[start:i+1]
+            if len(subseq) > min_length:
+                keep[subseq] = keep.get(subseq, 0) + 1
+            start = i
+    return nrecords
 
 
 def mask_filter(filename, min_quality, keep={}):
@@ -52,24 +74,179 @@ def mask_filter(filename, min_quality, keep={}):
 
     Adds distinct subsequences to dictionary `keep`, with the subsequence
     count as the value.
+
+    Returns the number of records read.
+    """
+    nrecords = 0
+    for batch in fastq.read(filename):
+        nrecords += len(batch)
+        masked = np.where(batch.quals >= min_quality, batch.seqs, ord("N")).astype(np.uint8)
+        masked = masked.tobytes().decode("ascii")
+        for start, end in zip(batch.starts.tolist(), batch.ends.tolist()):
+            seq = masked[start:end]
+            keep[seq] = keep.get(seq, 0) + 1
+    return nrecords
+
+
+class SpillingCounter(object):
+    """
+    Counts distinct sequences like the dictionary `keep` in the filters
+    above, but keeps at most about `memory` bytes of sequences in memory.
+
+    When the budget is exceeded, the in-memory counts are hash-partitioned by
+    sequence into temporary files under `tmpdir`. `by_count` then merges each
+    partition in turn, so the distinct sequences are returned in the same
+    order as counting them in a single dictionary.
     """
-    for seq in SeqIO.parse(filename, "fastq"):
-        quality = seq.letter_annotations["phred_quality"]
-        masked = []
-        for nt, q in zip(str(seq.seq), quality):
-            if q >= min_quality:
-                masked.append(nt)
-            else:
-                masked.append('N')
-        masked = "".join(masked)
-        keep[masked] = keep.get(masked, 0) + 1
+
+    # Approximate per-entry overhead of a dictionary key, count and hash slot
+    _overhead = 120
+
+    def __init__(self, memory, tmpdir=None, npartitions=256):
+        self.memory = memory
+        self.npartitions = npartitions
+        self.tmpdir = tempfile.mkdtemp(prefix="hivmmer-dedup-", dir=tmpdir)
+        self.counts = {}
+        self.size = 0
+        self.nspilled = 0
+        self.partitions = None
+        self.runs = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Remove the temporary partition files.
+        """
+        if self.partitions is not None:
+            for f in self.partitions:
+                f.close()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def get(self, seq, default=None):
+        return self.counts.get(seq, default)
+
+    def __setitem__(self, seq, n):
+        if seq not in self.counts:
+            self.size += len(seq) + self._overhead
+        self.counts[seq] = n
+        if self.size > self.memory:
+            self.spill()
+
+    def spill(self):
+        """
+        Append the in-memory counts to the partition files, recording the
+        order in which each sequence was first counted.
+        """
+        assert self.runs is None, "cannot add sequences after calling by_count"
+        if self.partitions is None:
+            self.partitions = [open(os.path.join(self.tmpdir, "partition{}".format(i)), "w")
+                               for i in range(self.npartitions)]
+        for i, (seq, n) in enumerate(self.counts.items(), start=self.nspilled):
+            f = self.partitions[zlib.crc32(seq.encode("ascii")) % self.npartitions]
+            f.write("{}\t{}\t{}\n".format(seq, n, i))
+        self.nspilled += len(self.counts)
+        self.counts = {}
+        self.size = 0
+
+    def extend(self, other):
+        """
+        Add the counts of the `SpillingCounter` `other`, as if its sequences
+        had been counted after those already in this counter, and close
+        `other`.
+        """
+        assert self.runs is None and other.runs is None, "cannot add sequences after calling by_count"
+        assert self.npartitions == other.npartitions, "counters have different numbers of partitions"
+        self.spill()
+        other.spill()
+        # Each partition lists its sequences in the order they were first
+        # counted, so appending the other counter's partitions after this
+        # counter's, with their order shifted past it, preserves that order
+        for f, theirs in zip(self.partitions, other.partitions):
+            theirs.close()
+            with open(theirs.name) as partition:
+                for line in partition:
+                    seq, n, first = line.split("\t")
+                    f.write("{}\t{}\t{}\n".format(seq, n, int(first) + self.nspilled))
+        self.nspilled += other.nspilled
+        other.close()
+
+    def _sort_partitions(self):
+        """
+        Total the counts in each partition and write them as a sorted run.
+        """
+        self.spill()
+        self.runs = []
+        for i, f in enumerate(self.partitions):
+            f.close()
+            merged = {}
+            with open(f.name) as partition:
+                for line in partition:
+                    seq, n, first = line.split("\t")
+                    if seq in merged:
+                        merged[seq][0] += int(n)
+                    else:
+                        merged[seq] = [int(n), int(first)]
+            os.remove(f.name)
+            run = os.path.join(self.tmpdir, "run{}".format(i))
+            with open(run, "w") as f:
+                for seq, (n, first) in sorted(merged.items(), key=lambda item: (-item[1][0], item[1][1])):
+                    f.write("{}\t{}\t{}\n".format(seq, n, first))
+            self.runs.append(run)
+
+    @staticmethod
+    def _read_run(run):
+        with open(run) as f:
+            for line in f:
+                seq, n, first = line.split("\t")
+                yield seq, int(n), int(first)
+
+    def by_count(self):
+        """
+        Returns an iterator over the distinct sequences/counts, ordered by
+        decreasing count and then by when they were first counted.
+        """
+        if self.partitions is None:
+            return iter(sorted(self.counts.items(), key=itemgetter(1), reverse=True))
+        if self.runs is None:
+            self._sort_partitions()
+        merged = heapq.merge(*map(self._read_run, self.runs), key=lambda record: (-record[1], record[2]))
+        return ((seq, n) for seq, n, _ in merged)
+
+
+def by_count(keep):
+    """
+    Returns the distinct sequences/counts in dictionary `keep`, ordered by
+    decreasing count.
+    """
+    if isinstance(keep, SpillingCounter):
+        return keep.by_count()
+    return sorted(keep.items(), key=itemgetter(1), reverse=True)
+
+
+def merge(keep, other):
+    """
+    Adds the distinct sequences/counts in `other` to `keep`, which are either
+    both dictionaries or both `SpillingCounter`s, as if the reads counted in
+    `other` had been counted after those in `keep`.
+    """
+    if isinstance(keep, SpillingCounter):
+        keep.extend(other)
+    else:
+        for seq, n in other.items():
+            keep[seq] = keep.get(seq, 0) + n
 
 
 def tofasta(keep, f):
     """
-    Writes distinct sequences/counts in dictionary `keep` to FASTA file `f`.
+    Writes distinct sequences/counts in dictionary `keep`, or a
+    `SpillingCounter`, to FASTA file `f`.
     """
-    for i, (seq, n) in enumerate(sorted(keep.items(), key=itemgetter(1), reverse=True)):
+    for i, (seq, n) in enumerate(by_count(keep)):
         print(">{}-{}".format(i, n), file=f)
         print(seq, file=f)
 
@@ -91,18 +268,25 @@ def _run():
                         choices=["mean", "split"],
                         default="mean",
                         help="filter on mean quality score vs. split into high-quality subsequences")
+    parser.add_argument("-M", "--memory",
+                        metavar="MB",
+                        type=int,
+                        help="deduplicate within a memory budget of MB megabytes, spilling to temporary files")
     parser.add_argument("FASTQ",
                         nargs="+",
-                        help="list of FASTQ input files to filter")
+                        help="list of FASTQ input files to filter, optionally gzipped")
     args= parser.parse_args()
 
-    keep = {}
+    keep = {} if args.memory is None else SpillingCounter(args.memory * 1048576)
     modes = {"mean": mean_filter, "split": split_filter}
 
-    for fastq in args.FASTQ:
-        modes[args.mode](fastq, args.min_length, args.min_quality, keep)
+    for filename in args.FASTQ:
+        modes[args.mode](filename, args.min_length, args.min_quality, keep)
 
     tofasta(keep, sys.stdout)
 
+    if args.memory is not None:
+        keep.close()
+
 
 # vim: expandtab sw=4 ts=4
@@ -0,0 +1,275 @@
+"""
+"""
+import mmap
+import os
+from collections import namedtuple
+
+Hit = namedtuple("Hit", ["id", "hsps"])
+Hit.__doc__ = """
+A target sequence reported by hmmsearch, with its list of `hsps`.
+"""
+
+HSP = namedtuple("HSP", ["bitscore", "query_start", "hit_start", "hit_span", "hmmseq", "hitseq"])
+HSP.__doc__ = """
+A single domain alignment, with 0-indexed `query_start` and `hit_start`
+coordinates following the Biopython SearchIO conventions. `hmmseq` and
+`hitseq` are the aligned HMM consensus and target sequence strings. In
+alignments read from Stockholm files, `hmmseq` marks match columns with "x"
+instead of the consensus residue, and insert columns with ".".
+"""
+
+def _is_coord(token):
+    return token.isdigit() or token == b"-"
+
+def split(filename, n):
+    """
+    Split hmmsearch text output `filename` into at most `n` shards of
+    roughly equal size that begin and end at hit boundaries.
+
+    Returns a list of (start, end) byte offsets that can be passed to `parse`.
+    """
+    size = os.path.getsize(filename)
+    offsets = [0]
+    with open(filename, "rb") as f:
+        for i in range(1, n):
+            f.seek(max(offsets[-1], i * size // n))
+            # Skip the (possibly partial) current line, then advance to the
+            # start of the next hit
+            f.readline()
+            offset = f.tell()
+            line = f.readline()
+            while line and not line.startswith(b">>"):
+                offset += len(line)
+                line = f.readline()
+            if not line:
+                break
+            if offset > offsets[-1]:
+                offsets.append(offset)
+    offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+def split_fasta(filename, n, prefix):
+    """
+    Split FASTA file `filename` into at most `n` chunk files of roughly equal
+    size, named `{prefix}.{i}`, without splitting records.
+
+    Returns the list of chunk files and the total number of sequences. An
+    empty file is returned as a single chunk.
+    """
+    size = os.path.getsize(filename)
+    chunks = []
+    nseqs = 0
+    written = 0
+    out = None
+    with open(filename, "rb") as f:
+        for line in f:
+            if line.startswith(b">"):
+                nseqs += 1
+                if out is None or (written >= len(chunks) * size // n and len(chunks) < n):
+                    if out is not None:
+                        out.close()
+                    chunks.append("{}.{}".format(prefix, len(chunks)))
+                    out = open(chunks[-1], "wb")
+            if out is not None:
+                out.write(line)
+            written += len(line)
+    if out is not None:
+        out.close()
+    else:
+        chunks.append(filename)
+    return chunks, nseqs
+
+def parse(filename, start=0, end=None):
+    """
+    Stream the hits in hmmsearch text output `filename`, yielding one `Hit`
+    at a time so that memory use does not grow with the size of the file.
+
+    Only hits that begin within the byte range [`start`, `end`) are parsed,
+    for use with the shards returned by `split`.
+    """
+    with open(filename, "rb") as f:
+
+        f.seek(start)
+        line = f.readline()
+        while line:
+
+            if not line.startswith(b">>"):
+                line = f.readline()
+                continue
+
+            if end is not None and f.tell() - len(line) >= end:
+                break
+
+            id = line[3:].split()[0].decode()
+            hsps = []
+
+            # Read through the domain table header
+            line = f.readline()
+            while line and not line.startswith(b" ---   ------") and not line.startswith(b"   [No individual domains"):
+                line = f.readline()
+            if line.startswith(b"   [No individual domains"):
+                yield Hit(id, hsps)
+                continue
+
+            # Parse the domain table
+            line = f.readline()
+            while line.strip():
+                row = line.split()
+                assert len(row) == 16
+                hsps.append([float(row[2]), int(row[6]) - 1, int(row[9]) - 1, int(row[10]) - int(row[9]) + 1])
+                line = f.readline()
+
+            # Read through to the alignments, if any
+            while line and not line.startswith(b"  Alignments for each domain:") \
+                       and not line.startswith(b">>") \
+                       and not line.startswith(b"Internal pipeline"):
+                line = f.readline()
+
+            if line.startswith(b"  Alignments for each domain:"):
+                line = f.readline()
+                for hsp in hsps:
+                    assert line.startswith(b"  == domain")
+                    hmmseq = []
+                    hitseq = []
+                    line = f.readline()
+                    while line and not line.startswith(b"  == domain") \
+                               and not line.startswith(b">>") \
+                               and not line.startswith(b"Internal pipeline"):
+                        # The HMM and target lines are the only lines in an
+                        # alignment block with a start and end coordinate
+                        tokens = line.split()
+                        if len(tokens) == 4 and _is_coord(tokens[1]) and _is_coord(tokens[3]):
+                            if len(hmmseq) == len(hitseq):
+                                hmmseq.append(tokens[2])
+                            else:
+                                hitseq.append(tokens[2])
+                        line = f.readline()
+                    hsp.append(b"".join(hmmseq).decode())
+                    hsp.append(b"".join(hitseq).decode())
+            else:
+                for hsp in hsps:
+                    hsp += [None, None]
+
+            yield Hit(id, [HSP(*hsp) for hsp in hsps])
+
+# Marks the insert (lowercase) residues of a Stockholm row with "."
+_insert_marks = bytes.maketrans(bytes(range(97, 123)) + bytes(range(65, 91)) + b"-",
+                                b"." * 26 + b"x" * 27)
+
+class Stockholm(object):
+    """
+    Random access to the rows of a Stockholm alignment written by
+    `hmmsearch -A`, without reading it into memory.
+
+    hmmsearch writes the alignment interleaved in blocks, in which each row
+    and its posterior probability line have the same length. Only the first
+    block is read to find the row names, and the rows of the other blocks
+    are located by their stride in the memory-mapped file.
+    """
+
+    def __init__(self, filename):
+        self.names = {}
+        self.blocks = []
+        self.rf = b""
+        self.file = open(filename, "rb")
+        if os.path.getsize(filename) == 0:
+            return
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        mm = self.mm
+        line = mm.readline()
+        assert line.startswith(b"# STOCKHOLM"), "{} is not a Stockholm file".format(filename)
+        while line:
+            line = mm.readline()
+            if not line.strip() or line.startswith(b"#=GF") or line.startswith(b"#=GS"):
+                continue
+            elif line.startswith(b"//"):
+                break
+            # The first row of a block
+            start = mm.tell() - len(line)
+            width = len(line.split()[1])
+            if not self.blocks:
+                # Read the row names from the first block
+                while not line.startswith(b"#=GC"):
+                    if not line.startswith(b"#=GR"):
+                        self.names[line.split()[0].decode()] = len(self.names)
+                    line = mm.readline()
+                mm.seek(start)
+                line = mm.readline()
+            stride = len(line)
+            if mm.readline().startswith(b"#=GR"):
+                stride *= 2
+            self.blocks.append((start, stride, len(line) - 1 - width, len(line) - 1))
+            # Skip the rest of the block
+            mm.seek(start + len(self.names) * stride)
+            line = mm.readline()
+            while line.startswith(b"#=GC"):
+                if line.startswith(b"#=GC RF"):
+                    self.rf += line.split()[2]
+                line = mm.readline()
+
+    def close(self):
+        if hasattr(self, "mm"):
+            self.mm.close()
+        self.file.close()
+
+    def row(self, name):
+        """
+        Returns the aligned row `name` as a byte string.
+        """
+        i = self.names[name]
+        return b"".join(self.mm[start + i * stride + begin:start + i * stride + end]
+                        for start, stride, begin, end in self.blocks)
+
+    def alignment(self, name):
+        """
+        Returns the HMM and target strings of the alignment in row `name`,
+        trimmed to its aligned residues, in the same format as the text
+        output.
+        """
+        # Drop the insert columns where this row has no residue ("."), and
+        # the match columns before and after the aligned region ("-"). The
+        # remaining insert columns are the lowercase residues.
+        row = self.row(name)
+        if b"*" not in row:
+            hitseq = row.replace(b".", b"").strip(b"-")
+            return hitseq.translate(_insert_marks).decode(), hitseq.decode()
+        # Stop codons have no case, so look up their columns in the
+        # reference annotation instead
+        columns = [i for i, aa in enumerate(row) if aa != ord(".")]
+        residues = [i for i in columns if row[i] != ord("-")]
+        columns = [i for i in columns if residues[0] <= i <= residues[-1]]
+        hmmseq = bytes(ord("x") if self.rf[i] == ord("x") else ord(".") for i in columns)
+        return hmmseq.decode(), bytes(row[i] for i in columns).decode()
+
+def parse_tabular(domtblfile, stofile):
+    """
+    Stream the hits in the `--domtblout` table `domtblfile` of an hmmsearch
+    run, yielding one `Hit` at a time with the scores and coordinates of each
+    domain from the table and its aligned residues from the `-A` Stockholm
+    alignment `stofile`.
+
+    hmmsearch only writes the domains that satisfy the inclusion thresholds
+    to `stofile`, so it should be run with `--incE` and `--incdomE` equal to
+    the reporting thresholds (by default, 10).
+    """
+    alignment = Stockholm(stofile)
+    try:
+        with open(domtblfile) as f:
+            hit = None
+            for line in f:
+                if line.startswith("#"):
+                    continue
+                row = line.split()
+                if hit is None or row[0] != hit.id:
+                    if hit is not None:
+                        yield hit
+                    hit = Hit(row[0], [])
+                alifrom, alito = int(row[17]), int(row[18])
+                hmmseq, hitseq = alignment.alignment("{}/{}-{}".format(row[0], alifrom, alito))
+                hit.hsps.append(HSP(float(row[13]), int(row[15]) - 1, alifrom - 1, alito - alifrom + 1, hmmseq, hitseq))
+            if hit is not None:
+                yield hit
+    finally:
+        alignment.close()
+
+# vim: expandtab sw=4 ts=4
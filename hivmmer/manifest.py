@@ -0,0 +1,115 @@
+"""
+Content-addressed manifests for the stages of the hivmmer pipeline, so that
+a rerun in the same output directory skips the stages whose inputs,
+parameters and hivmmer version are unchanged.
+"""
+import hashlib
+import json
+import os
+from importlib import resources
+
+_version = resources.read_text("hivmmer", "VERSION").strip()
+
+def _stat(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+def digest(path, known=None):
+    """
+    Returns the SHA-256 digest of the contents of file `path`.
+
+    `known` is an optional previous record of the file, as returned by
+    `record`, whose digest is reused without reading the file if the size and
+    modification time are the same.
+    """
+    size, mtime = _stat(path)
+    if known is not None and known.get("size") == size and known.get("mtime_ns") == mtime:
+        return known["sha256"]
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def record(path, known=None):
+    """
+    Returns a record of the size, modification time and digest of file
+    `path`.
+    """
+    size, mtime = _stat(path)
+    return {"size": size, "mtime_ns": mtime, "sha256": digest(path, known)}
+
+class Stage(object):
+    """
+    The manifest of a pipeline stage `name`, stored in
+    `{manifestdir}/{name}.json`, with the digests of its `inputs` and
+    outputs, its `params` and the hivmmer version.
+
+    A stage is fresh if its manifest matches the current inputs, parameters
+    and version, and all of its recorded outputs are unchanged. Since the
+    outputs of one stage are the inputs of the next, a stage that reruns
+    and produces different outputs makes the downstream stages stale.
+    """
+
+    def __init__(self, name, inputs, params=None, manifestdir=os.path.join("logs", "manifests")):
+        self.name = name
+        self.inputs = list(inputs)
+        self.params = {} if params is None else params
+        self.path = os.path.join(manifestdir, "{}.json".format(name))
+        self.manifest = None
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.manifest = json.load(f)
+
+    def _known(self, kind, path):
+        if self.manifest is None:
+            return None
+        return self.manifest[kind].get(path)
+
+    def fresh(self):
+        """
+        Returns True if the stage can be skipped.
+        """
+        m = self.manifest
+        if m is None or m["version"] != _version or m["params"] != json.loads(json.dumps(self.params)):
+            return False
+        if sorted(m["inputs"]) != sorted(self.inputs):
+            return False
+        for kind in ("inputs", "outputs"):
+            for path, known in m[kind].items():
+                if not os.path.exists(path) or digest(path, known) != known["sha256"]:
+                    return False
+        return True
+
+    @property
+    def result(self):
+        """
+        The JSON-serializable return value of the stage, if one was recorded.
+        """
+        return self.manifest.get("result")
+
+    def record(self, outputs, result=None):
+        """
+        Write the manifest after the stage has produced `outputs`, with an
+        optional `result` that later runs can use in place of rerunning the
+        stage.
+        """
+        self.manifest = {"version": _version,
+                         "params": self.params,
+                         "inputs": dict((path, record(path, self._known("inputs", path))) for path in self.inputs),
+                         "outputs": dict((path, record(path)) for path in outputs),
+                         "result": result}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(self.path + ".tmp", self.path)
+
+    def invalidate(self):
+        """
+        Remove the manifest, e.g. before rerunning the stage.
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.manifest = None
+
+# vim: expandtab sw=4 ts=4
@@ -0,0 +1,433 @@
+"""
+Python API for the stages of the hivmmer pipeline.
+
+The deduplicated reads are handed from the filter stage to translation and
+codon extraction as a packed, memory-mapped `hivmmer.reads.ReadStore`, rather
+than through intermediate FASTA files. The only FASTA file that has to be
+written is the translated reads that are the input to hmmsearch; the
+deduplicated reads are written as FASTA only on request, for debugging.
+
+PEAR's merged reads can also be streamed into the filter stage through named
+pipes (see `stream_deduplicate`), so that they are only written to disk on
+request.
+"""
+import errno
+import io
+import os
+import shutil
+import signal
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from . import data
+from . import filter
+from . import hmmer
+from . import profile
+from . import reads
+from .codons import codons
+from .counts import CodonCounts
+from .translate import translate
+
+
+def deduplicate(fastqs, prefix, min_length=75, min_quality=25, memory=None, tmpdir=None, fasta=None):
+    """
+    Filter the reads in each file in `fastqs` by length and mean quality,
+    deduplicate them, and write them to a packed read store at `prefix`.
+
+    With a `memory` budget in bytes, distinct reads beyond the budget are
+    spilled to `tmpdir`. If `fasta` is a path, the deduplicated reads are also
+    written to it as FASTA.
+
+    Returns the `hivmmer.reads.ReadStore` and the number of reads in
+    `fastqs`.
+    """
+    if memory is None:
+        keep = {}
+    else:
+        keep = filter.SpillingCounter(memory, tmpdir=tmpdir)
+    try:
+        nreads = 0
+        for fastq in fastqs:
+            nreads += filter.mean_filter(fastq, min_length, min_quality, keep)
+        return _write(keep, prefix, fasta), nreads
+    finally:
+        if memory is not None:
+            keep.close()
+
+
+def _write(keep, prefix, fasta=None):
+    if fasta is not None:
+        with open(fasta, "w") as f:
+            filter.tofasta(keep, f)
+    return reads.write(keep, prefix)
+
+
+_pear_outputs = ("assembled", "unassembled.forward", "unassembled.reverse")
+
+
+def pearfiles(prefix):
+    """
+    Returns the paths of the FASTQ files of assembled and unassembled reads
+    that PEAR writes with the output prefix `prefix`.
+    """
+    return ["{}.{}.fastq".format(prefix, output) for output in _pear_outputs]
+
+
+def _pear(fastq1, fastq2, prefix, threads):
+    return ["pear", "-y", "1G", "-f", fastq1, "-r", fastq2, "-o", prefix, "-k", "-j", str(threads)]
+
+
+def pear(fastq1, fastq2, prefix, logfile, threads=1):
+    """
+    Merge the paired reads in `fastq1` and `fastq2` with PEAR, writing the
+    assembled and unassembled reads to `pearfiles(prefix)` and the console
+    output to `logfile`.
+
+    Returns a record of the job's wall time, CPU time and peak resident set
+    size (see `hivmmer.profile.run`).
+    """
+    with open(logfile, "w") as log:
+        status, usage = profile.run(_pear(fastq1, fastq2, prefix, threads), stdout=log, stderr=log)
+    assert status == 0, "ERROR: PEAR exited with status {} - check {}".format(status, os.path.basename(logfile))
+    return usage
+
+
+def pear_counts(logfile):
+    """
+    Read the summary at the end of PEAR's console output `logfile`.
+
+    Returns the number of read pairs that PEAR read and the number of reads
+    that it wrote to `pearfiles` (each assembled pair, and both reads of
+    each pair that was not assembled), or None if there is no summary.
+    """
+    counts = {}
+    with open(logfile) as f:
+        for line in f:
+            label, sep, value = line.partition(":")
+            label = label.rstrip(" .")
+            if sep and label in ("Assembled reads", "Not assembled reads"):
+                n, _, total = value.split("(")[0].partition("/")
+                counts[label] = (int(n.replace(",", "")), int(total.replace(",", "")))
+    if len(counts) < 2:
+        return None
+    return counts["Assembled reads"][1], counts["Assembled reads"][0] + 2 * counts["Not assembled reads"][0]
+
+
+class _Tee(io.RawIOBase):
+    """
+    Reads the unbuffered binary file `f`, copying the bytes read to the
+    binary file `copy`.
+    """
+
+    def __init__(self, f, copy):
+        self.f = f
+        self.copy = copy
+        self.name = f.name
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.f.readinto(b)
+        if n:
+            self.copy.write(memoryview(b)[:n])
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.f.close()
+            self.copy.close()
+        super().close()
+
+
+def _filter_pipe(fifo, copy, min_length, min_quality, keep):
+    """
+    Filter the reads from the named pipe `fifo` into `keep`, copying them to
+    `copy` unless it is None, and return the number of reads.
+    """
+    f = open(fifo, "rb", buffering=0)
+    if copy is not None:
+        try:
+            f = _Tee(f, open(copy, "wb"))
+        except OSError:
+            f.close()
+            raise
+    with io.BufferedReader(f, 1 << 20) as f:
+        return filter.mean_filter(f, min_length, min_quality, keep)
+
+
+def _release(fifos, futures):
+    """
+    Open and close the write end of each of the named pipes `fifos` until
+    the future reading it is done, so that a reader still waiting to open
+    its pipe, because the writer exited without opening it, reads end of
+    file instead of waiting forever.
+    """
+    for fifo, future in zip(fifos, futures):
+        while not future.done():
+            try:
+                os.close(os.open(fifo, os.O_WRONLY | os.O_NONBLOCK))
+            except OSError as e:
+                # The reader has not opened the pipe yet
+                if e.errno != errno.ENXIO:
+                    raise
+            wait([future], timeout=0.1)
+
+
+def stream_deduplicate(fastq1, fastq2, prefix, logfile, min_length=75, min_quality=25, threads=1,
+                       memory=None, tmpdir=None, fasta=None, keep=None, jobs=None):
+    """
+    Merge the paired reads in `fastq1` and `fastq2` with PEAR (see `pear`),
+    and filter and deduplicate the merged reads while PEAR writes them, as
+    `deduplicate` does with PEAR's output files.
+
+    PEAR writes to named pipes in a temporary directory under `tmpdir`,
+    which are read concurrently, by a thread each, so that PEAR never waits
+    for one pipe to be read while the filter waits for another. The reads
+    from each pipe are counted separately and merged in the order of
+    `pearfiles`, so the read store is the same as with `deduplicate`. A
+    `memory` budget is shared equally between the pipes.
+
+    If `keep` is a prefix, PEAR's outputs are also copied to `pearfiles(keep)`
+    as they are read. If `jobs` is a list, a record of PEAR's resource usage
+    and of the number of reads it wrote is appended to it.
+
+    Returns the `hivmmer.reads.ReadStore` and the number of reads that PEAR
+    wrote.
+    """
+    workdir = tempfile.mkdtemp(prefix="hivmmer-pear-", dir=tmpdir)
+    fifos = pearfiles(os.path.join(workdir, "pear"))
+    copies = [None] * len(fifos) if keep is None else pearfiles(keep)
+    if memory is None:
+        counters = [{} for _ in fifos]
+    else:
+        counters = [filter.SpillingCounter(memory // len(fifos), tmpdir=tmpdir) for _ in fifos]
+    try:
+        for fifo in fifos:
+            os.mkfifo(fifo)
+        with ThreadPoolExecutor(len(fifos)) as executor:
+            futures = [executor.submit(_filter_pipe, fifo, copy, min_length, min_quality, counter)
+                       for fifo, copy, counter in zip(fifos, copies, counters)]
+            try:
+                with open(logfile, "w") as log:
+                    status, usage = profile.run(_pear(fastq1, fastq2, os.path.join(workdir, "pear"), threads),
+                                                stdout=log, stderr=log)
+            finally:
+                _release(fifos, futures)
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        # A reader that fails closes its pipe, which stops PEAR with SIGPIPE
+        # (or a shell wrapper with status 128 + SIGPIPE)
+        if errors and status in (0, -signal.SIGPIPE, 128 + signal.SIGPIPE):
+            raise errors[0]
+        assert status == 0, "ERROR: PEAR exited with status {} - check {}".format(status, os.path.basename(logfile))
+        if keep is not None and os.path.exists(os.path.join(workdir, "pear.discarded.fastq")):
+            os.replace(os.path.join(workdir, "pear.discarded.fastq"), "{}.discarded.fastq".format(keep))
+        nreads = sum(future.result() for future in futures)
+        if jobs is not None:
+            jobs.append(OrderedDict([("name", "pear")] + list(usage.items()) + [("records_out", nreads)]))
+        for counter in counters[1:]:
+            filter.merge(counters[0], counter)
+        return _write(counters[0], prefix, fasta), nreads
+    finally:
+        if memory is not None:
+            for counter in counters:
+                counter.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def translate_reads(store, pfafile, logfile, max_stops=None):
+    """
+    Translate the reads in `store` to all six frames, writing the amino acid
+    sequences to FASTA file `pfafile` for hmmsearch and summary statistics
+    to `logfile`. Frames with more than `max_stops` internal stop codons are
+    pruned, unless it is None.
+
+    Returns the number of translated sequences written.
+    """
+    with open(pfafile, "w") as f, open(logfile, "w") as log:
+        return translate(store, f, log, max_stops=max_stops)
+
+
+def hmmsearch(hmmfile, pfafile, outfile, logfile, threads=1, Z=None):
+    """
+    Align the translated reads in `pfafile` to the pHMM in `hmmfile`, writing
+    the alignments to `outfile`. If `Z` is not None, it sets the number of
+    sequences used for E-values, as when `pfafile` is a chunk of a larger
+    database.
+
+    `outfile` is either a path for the text output, or a pair of paths for
+    a `--domtblout` domain table and `-A` Stockholm alignment, in which case
+    the text output is discarded.
+
+    Returns a record of the job's wall time, CPU time, peak resident set size
+    and bytes read and written (see `hivmmer.profile.run`).
+    """
+    if isinstance(outfile, tuple):
+        # Include every reported domain in the Stockholm alignment
+        output = ["-o", os.devnull, "--noali",
+                  "--incE", "10", "--incdomE", "10",
+                  "--domtblout", outfile[0],
+                  "-A", outfile[1]]
+    else:
+        output = ["-o", outfile]
+    with open(logfile, "w") as log:
+        status, usage = profile.run(["hmmsearch", "--max",
+                                     "--cpu", str(threads)] +
+                                    ([] if Z is None else ["-Z", str(Z)]) +
+                                    output +
+                                    [hmmfile,
+                                     pfafile],
+                                    stdout=log,
+                                    stderr=log)
+    assert status == 0, "ERROR: hmmsearch exited with status {} - check {}".format(status, os.path.basename(logfile))
+    usage["bytes_in"] = profile.nbytes([pfafile])
+    usage["bytes_out"] = profile.nbytes(outfile if isinstance(outfile, tuple) else [outfile])
+    return usage
+
+
+def _hmm_length(gene):
+    """
+    Returns the number of match states in the prepackaged pHMM for `gene`.
+    """
+    return int(data.table("{}.hxb2".format(gene))["hmm"].max())
+
+
+def align(genes, hmmdir, pfafile, outdir, logdir, threads=1, nchunks=None, Z=None, tabular=False, jobs=None):
+    """
+    Align the translated reads in `pfafile` to the pHMM `{hmmdir}/{gene}.hmm`
+    for each gene in `genes`, running up to `threads` single-threaded
+    hmmsearch jobs at a time.
+
+    `pfafile` is either a single FASTA file that is searched for every gene,
+    or a dictionary mapping each gene to the FASTA file of the sequences
+    routed to it by `hivmmer.route.route`. In the latter case, `Z` should be
+    the total number of translated sequences, so that E-values are the same
+    as a search of all sequences; otherwise, each FASTA file is searched
+    with its own number of sequences as the search space.
+
+    Each FASTA file is split into `nchunks` chunks (by default, `threads`),
+    and each gene is searched against each chunk as a separate job. Jobs are
+    started in order of decreasing HMM length times chunk size, so that the
+    long pol and env searches start first and the short genes fill in the
+    remaining cores. Each chunk is searched with `-Z` set to the number of
+    sequences in its whole FASTA file (or to `Z`), so that E-values are the
+    same as in a single search.
+
+    Returns an ordered dictionary mapping each gene to the list of its
+    hmmsearch text outputs, one for each chunk: `{outdir}/{gene}.txt` if
+    there is a single chunk, and otherwise `{outdir}/{gene}.{i}.txt`. Each
+    gene maps to a list even if there is a single chunk. The list can be
+    passed directly to `hivmmer.codons`, which counts each chunk separately. hmmsearch logs are written to `{logdir}/hmmsearch.{gene}.log`.
+
+    If `tabular` is true, hmmsearch writes a domain table and Stockholm
+    alignment instead, and each gene maps to a list of
+    (`{outdir}/{gene}.{i}.domtbl`, `{outdir}/{gene}.{i}.sto`) pairs, one for
+    each chunk.
+
+    If `jobs` is a list, the resource usage of each hmmsearch job is appended
+    to it, in the order the jobs were started.
+    """
+    if nchunks is None:
+        nchunks = threads
+
+    if isinstance(pfafile, str):
+        databases = dict((gene, pfafile) for gene in genes)
+    else:
+        databases = pfafile
+
+    # Split each distinct database once
+    splits = {}
+    for database in databases.values():
+        if database not in splits:
+            if nchunks > 1:
+                splits[database] = hmmer.split_fasta(database, nchunks, database)
+            else:
+                splits[database] = ([database], None)
+    chunks = dict((gene, splits[databases[gene]][0]) for gene in genes)
+
+    if tabular:
+        alignments = OrderedDict((gene, [(os.path.join(outdir, "{}.{}.domtbl".format(gene, i)),
+                                          os.path.join(outdir, "{}.{}.sto".format(gene, i)))
+                                         for i in range(len(chunks[gene]))])
+                                 for gene in genes)
+    else:
+        alignments = OrderedDict((gene, [os.path.join(outdir, "{}.txt".format(gene))] if len(chunks[gene]) == 1 else
+                                        [os.path.join(outdir, "{}.{}.txt".format(gene, i)) for i in range(len(chunks[gene]))])
+                                 for gene in genes)
+    queue = []
+    for gene in genes:
+        if os.path.getsize(databases[gene]) == 0:
+            # hmmsearch rejects an empty database, so leave empty output
+            # files, which have no hits
+            for outfile in (alignments[gene][0] if tabular else alignments[gene][:1]):
+                open(outfile, "w").close()
+            with open(os.path.join(logdir, "hmmsearch.{}.log".format(gene)), "w") as log:
+                print("No sequences to search in", databases[gene], file=log)
+            chunks[gene] = []
+            continue
+        for i, chunk in enumerate(chunks[gene]):
+            if len(chunks[gene]) > 1:
+                suffix = ".{}".format(i)
+            else:
+                suffix = ""
+            queue.append((_hmm_length(gene) * os.path.getsize(chunk),
+                          gene,
+                          os.path.join(hmmdir, "{}.hmm".format(gene)),
+                          chunk,
+                          alignments[gene][i],
+                          os.path.join(logdir, "hmmsearch.{}.log{}".format(gene, suffix)),
+                          splits[databases[gene]][1] if Z is None else Z))
+    queue.sort(key=lambda job: job[0], reverse=True)
+
+    try:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = [executor.submit(hmmsearch, hmmfile, chunk, outfile, logfile, 1, nseqs)
+                       for _, _, hmmfile, chunk, outfile, logfile, nseqs in queue]
+            for future, (_, gene, _, chunk, _, _, _) in zip(futures, queue):
+                usage = future.result()
+                if jobs is not None:
+                    jobs.append(OrderedDict([("name", "hmmsearch"), ("gene", gene), ("chunk", chunk)] +
+                                            list(usage.items())))
+    finally:
+        for database, (files, _) in splits.items():
+            for chunk in files:
+                if chunk != database:
+                    os.remove(chunk)
+
+    for gene in genes:
+        if len(chunks[gene]) > 1:
+            logfile = os.path.join(logdir, "hmmsearch.{}.log".format(gene))
+            with open(logfile, "w") as log:
+                for i in range(len(chunks[gene])):
+                    with open("{}.{}".format(logfile, i)) as f:
+                        log.write(f.read())
+                    os.remove("{}.{}".format(logfile, i))
+
+    return alignments
+
+
+def extract_codons(store, alignments, processes=1, jobs=None):
+    """
+    Count codons for each gene in the ordered dictionary `alignments`, which
+    maps each gene to its hmmsearch output, and concatenate them into a
+    single `hivmmer.counts.CodonCounts` table.
+
+    If `jobs` is a list, a record of the wall time, CPU time (including any
+    worker processes) and number of codons counted for each gene is appended
+    to it.
+    """
+    counts = []
+    for gene, hmmerfile in alignments.items():
+        start = time.perf_counter()
+        cpu = profile.cpu()
+        counts.append(codons(store, hmmerfile, gene, processes=processes))
+        if jobs is not None:
+            jobs.append(OrderedDict([("name", "codons"),
+                                     ("gene", gene),
+                                     ("wall_s", round(time.perf_counter() - start, 3)),
+                                     ("cpu_s", round(profile.cpu() - cpu, 3)),
+                                     ("records_out", int(counts[-1].counts[:, :64].sum()))]))
+    return CodonCounts.concat(counts)
+
+# vim: expandtab sw=4 ts=4
@@ -0,0 +1,143 @@
+"""
+Per-stage performance profile of the hivmmer pipeline: wall time, CPU time,
+peak resident memory, bytes read and written, and record counts, written to
+a JSON file after each stage so that a failed run still has a profile.
+"""
+import cProfile
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from importlib import resources
+
+_version = resources.read_text("hivmmer", "VERSION").strip()
+
+def _reset_peak_rss():
+    """
+    Reset the peak resident set size (VmHWM) of this process, which is
+    supported by Linux 4.0 or later. Returns False if it is not supported,
+    in which case the peak is the lifetime peak of the process.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def _peak_rss():
+    """
+    Returns the peak resident set size of this process in KiB.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _cpu(usage):
+    return usage.ru_utime + usage.ru_stime
+
+def cpu():
+    """
+    Returns the CPU time used so far by this process and its waited-for
+    children, such as the workers of a finished process pool.
+    """
+    return _cpu(resource.getrusage(resource.RUSAGE_SELF)) + _cpu(resource.getrusage(resource.RUSAGE_CHILDREN))
+
+def nbytes(paths):
+    """
+    Returns the total size of the existing files in `paths`.
+    """
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+def run(args, stdout=None, stderr=None):
+    """
+    Run the command `args` like `subprocess.run`, and collect the resource
+    usage of the child process with `os.wait4`, which is exact even if
+    other children run concurrently.
+
+    Returns the exit status and a dictionary with the wall time, CPU time
+    and peak resident set size of the child.
+    """
+    start = time.perf_counter()
+    p = subprocess.Popen(args, stdout=stdout, stderr=stderr)
+    _, status, usage = os.wait4(p.pid, 0)
+    p.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    return p.returncode, OrderedDict([("wall_s", round(time.perf_counter() - start, 3)),
+                                      ("cpu_s", round(_cpu(usage), 3)),
+                                      ("peak_rss_kb", usage.ru_maxrss)])
+
+class Profile(object):
+    """
+    Collects a record of each pipeline stage, and writes them to JSON file
+    `path` after each stage.
+
+    If `cprofiledir` is not None, each stage is also profiled with cProfile,
+    and its stats are written to `{cprofiledir}/{stage}.prof`, which can be
+    read with `pstats`. cProfile only covers the main thread, so it is
+    useful for the Python stages, not for PEAR or hmmsearch.
+    """
+
+    def __init__(self, path, cprofiledir=None):
+        self.path = path
+        self.cprofiledir = cprofiledir
+        self.profile = OrderedDict([("version", _version),
+                                    ("command", sys.argv),
+                                    ("started", time.strftime("%Y-%m-%dT%H:%M:%S%z")),
+                                    ("stages", [])])
+        if cprofiledir is not None:
+            os.makedirs(cprofiledir, exist_ok=True)
+
+    @contextmanager
+    def stage(self, name, inputs=(), outputs=()):
+        """
+        Profile the stage `name`, which reads the files `inputs` and writes
+        the files `outputs`.
+
+        Yields the stage's record, a dictionary to which the caller can add
+        "records_in" and "records_out" counts, a "jobs" list of subprocess
+        records, "skipped" if the stage did not have to run, or "bytes_in"
+        and "bytes_out" if the files are only known once the stage has run.
+        """
+        record = OrderedDict([("name", name)])
+        self.profile["stages"].append(record)
+        profiler = None if self.cprofiledir is None else cProfile.Profile()
+        reset = _reset_peak_rss()
+        start = time.perf_counter()
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(os.path.join(self.cprofiledir, "{}.prof".format(name)))
+            record["wall_s"] = round(time.perf_counter() - start, 3)
+            record["cpu_s"] = round(_cpu(resource.getrusage(resource.RUSAGE_SELF)) - _cpu(usage), 3)
+            record["children_cpu_s"] = round(_cpu(resource.getrusage(resource.RUSAGE_CHILDREN)) - _cpu(children), 3)
+            record["peak_rss_kb"] = _peak_rss()
+            if not reset:
+                record["peak_rss_lifetime"] = True
+            record["bytes_in"] = record.pop("bytes_in", nbytes(inputs))
+            record["bytes_out"] = record.pop("bytes_out", nbytes(outputs))
+            for key in ("records_in", "records_out", "jobs"):
+                if key in record:
+                    record.move_to_end(key)
+            self.write()
+
+    def write(self):
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.profile, f, indent=1)
+        os.replace(self.path + ".tmp", self.path)
+
+# vim: expandtab sw=4 ts=4
@@ -0,0 +1,105 @@
+"""
+"""
+import numpy as np
+import os
+from array import array
+from hivmmer.filter import by_count
+
+def _paths(prefix):
+    return {"seq": prefix + ".seq", "idx": prefix + ".idx.npy", "count": prefix + ".count.npy"}
+
+def write(keep, prefix):
+    """
+    Write the distinct sequences/counts in `keep` (a dictionary or a
+    `hivmmer.filter.SpillingCounter`) to a packed read store at `prefix`,
+    numbered in the same order as `hivmmer.filter.tofasta`, and return it
+    as a `ReadStore`.
+
+    The store consists of three files: the contiguous sequence bytes
+    (`prefix.seq`), and NumPy arrays with the offset of each read in those
+    bytes (`prefix.idx.npy`) and the count of each read (`prefix.count.npy`).
+    """
+    paths = _paths(prefix)
+    offsets = array("q", [0])
+    counts = array("q")
+    with open(paths["seq"], "wb") as f:
+        for seq, count in by_count(keep):
+            seq = seq.encode("ascii")
+            f.write(seq)
+            offsets.append(offsets[-1] + len(seq))
+            counts.append(count)
+    np.save(paths["idx"], np.frombuffer(offsets, dtype=np.int64))
+    np.save(paths["count"], np.frombuffer(counts, dtype=np.int64))
+    return ReadStore(prefix)
+
+def files(prefix):
+    """
+    Returns the paths of the files of a packed read store at `prefix`.
+    """
+    return sorted(_paths(prefix).values())
+
+def exists(prefix):
+    """
+    Test whether a packed read store exists at `prefix`.
+    """
+    return all(map(os.path.exists, _paths(prefix).values()))
+
+class ReadStore(object):
+    """
+    Read-only, memory-mapped view of a packed read store written by `write`.
+
+    Reads are looked up by their number, i.e. the leading integer in the
+    `{i}-{count}` identifiers written by `hivmmer.filter.tofasta`. Since the
+    files are memory-mapped, any number of processes can open the same store
+    and share its pages without copying.
+    """
+
+    def __init__(self, prefix):
+        paths = _paths(prefix)
+        self.prefix = prefix
+        if os.path.getsize(paths["seq"]) > 0:
+            self.seqs = np.memmap(paths["seq"], dtype=np.uint8, mode="r")
+        else:
+            self.seqs = np.empty(0, dtype=np.uint8)
+        self.offsets = np.load(paths["idx"], mmap_mode="r")
+        self.counts = np.load(paths["count"], mmap_mode="r")
+
+    def __reduce__(self):
+        # Reopen the memory maps by path, rather than pickling their contents
+        return (ReadStore, (self.prefix,))
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __getitem__(self, i):
+        return self.seqs[self.offsets[i]:self.offsets[i+1]].tobytes().decode("ascii")
+
+    def id(self, i):
+        """
+        Return the `{i}-{count}` identifier for read number `i`.
+        """
+        return "{}-{}".format(i, self.counts[i])
+
+    def sequence(self, id):
+        """
+        Return the sequence with identifier `id`.
+        """
+        return self[int(id.partition("-")[0])]
+
+    def records(self):
+        """
+        Yield the (identifier, sequence) of each read, in order.
+        """
+        for i in range(len(self)):
+            yield self.id(i), self[i]
+
+    def tofasta(self, f):
+        """
+        Write the reads to FASTA file `f`, in the same format as
+        `hivmmer.filter.tofasta`.
+        """
+        for id, seq in self.records():
+            print(">" + id, file=f)
+            print(seq, file=f)
+
+# vim: expandtab sw=4 ts=4
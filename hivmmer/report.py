@@ -5,14 +5,19 @@ import matplotlib
 matplotlib.rcParams["font.sans-serif"] = ["Nimbus Sans L", "Helvetica", "Arial"]
 
 import hivmmer
+import hivmmer.table
 import matplotlib.pyplot as plt
-import numpy as np
 import os
 import pandas as pd
+import textwrap
 import time
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from hivmmer.counts import read_frame
+from matplotlib.backends.backend_pdf import PdfPages
 from matplotlib.ticker import FixedLocator
+from matplotlib.transforms import Bbox
 from subprocess import run
 
 _genes = {
@@ -28,17 +33,94 @@ _genes = {
 _end = 9417
 
 
-def plot_coverage(codonfile, outfile, min_coverage=1000):
+# Offsets that serialize the PR, RT and IN positions on a single x axis
+_offsets = {"RT": 100, "IN": 541}
+
+# Sizes and line widths in rcParams that `_scaled` multiplies, to draw a
+# figure smaller than its standalone size with the same proportions
+_scalable = ["font.size", "axes.linewidth", "axes.labelpad", "grid.linewidth",
+             "lines.linewidth", "lines.markersize", "patch.linewidth"] + \
+            ["%s.%s.%s" % (axis, which, key) for axis in ("xtick", "ytick")
+                                             for which in ("major", "minor")
+                                             for key in ("size", "width", "pad")]
+
+ReportData = namedtuple("ReportData", ["coverage", "prrt_coverage", "frequencies", "drms"])
+ReportData.__doc__ = """
+The data behind the report figures: the whole genome `coverage` by HXB2
+position, the PR/RT/IN coverage `prrt_coverage` by serialized x coordinate,
+the `frequencies` of each variant at each x coordinate, and the identified
+`drms` with their x coordinates.
+"""
+
+
+def _scaled(scale):
     """
-    Write a PDF plot to `outfile` showing the coverage at each HXB2 position
-    based on the codon counts in `codonfile`.
+    Returns the rcParams in `_scalable` multiplied by `scale`.
     """
-    codons = pd.read_csv(codonfile, sep="\t", index_col="hxb2").fillna("")
-    coverage = codons.groupby(level=0)["count"].sum()
-    max_coverage = coverage.max()
+    return dict((key, scale * matplotlib.rcParams[key]) for key in _scalable)
+
+
+def _serialize(frame):
+    """
+    Returns the x coordinate of each row of `frame` with the PR, RT and IN
+    positions in its `region` and `position` columns placed side by side.
+    """
+    x = frame["position"].copy()
+    for region, offset in _offsets.items():
+        x[frame["region"] == region] += offset
+    return x
+
+
+def _load_coverage(codonfile):
+    """
+    Returns the coverage at each HXB2 position from the codon counts in
+    `codonfile`.
+    """
+    return read_frame(codonfile).groupby(level=0)["count"].sum()
+
+
+def _load_aa(aafile):
+    """
+    Returns the coverage at each x coordinate of the PR/RT/IN amino acid
+    table `aafile`, and the unpivoted frequency of each variant.
+    """
+    aa = hivmmer.table.read_frame(aafile)
+    aa["x"] = _serialize(aa)
+    del aa["region"]
+    del aa["position"]
+    coverage = aa.groupby("x")["coverage"].sum()
+    del aa["hxb2"]
+    aa = aa.melt(id_vars=["x", "coverage"], var_name="variant", value_name="count")
+    aa["frequency"] = aa["count"] / aa["coverage"]
+    return coverage, aa
+
+
+def _load_drms(drmfile):
+    """
+    Returns the DRMs in `drmfile`, with their x coordinates.
+    """
+    drm = pd.read_csv(drmfile)
+    drm["x"] = _serialize(drm)
+    return drm
+
+
+def load(codonfile, aafile, drmfile):
+    """
+    Load the codon counts in `codonfile`, the amino acid table in `aafile`
+    and the DRMs in `drmfile` once for all of the report figures.
+
+    Returns a `ReportData`.
+    """
+    prrt_coverage, frequencies = _load_aa(aafile)
+    return ReportData(_load_coverage(codonfile), prrt_coverage, frequencies, _load_drms(drmfile))
 
-    # Initialize plot
-    fig, ax = plt.subplots(1, 1, figsize=(10, 2))
+
+def draw_coverage(coverage, ax, min_coverage=1000, scale=1):
+    """
+    Draw the whole genome `coverage` at each HXB2 position on the axes `ax`,
+    with the tick label font sizes multiplied by `scale`.
+    """
+    max_coverage = coverage.max()
 
     # Draw coverage
     xlim = (min(_genes.values()), _end)
@@ -48,42 +130,24 @@ def plot_coverage(codonfile, outfile, min_coverage=1000):
     # Setup x axis
     ax.set_xlim(xlim)
     ax.set_xticks(list(_genes.values()))
-    ax.set_xticklabels(list(_genes.values()), rotation=90)
+    ax.set_xticklabels(list(_genes.values()), fontsize=10*scale, rotation=90)
     ax2 = ax.twiny()
     ax2.set_xlim(ax.get_xlim())
     ax2.set_xticks(list(_genes.values()))
-    ax2.set_xticklabels(list(_genes.keys()), rotation=90)
+    ax2.set_xticklabels(list(_genes.keys()), fontsize=10*scale, rotation=90)
     ax.grid(axis="x")
 
     # Setup y axis
     ax.set_ylim(0, max(min_coverage, max_coverage))
     ax.set_yticks([min_coverage, max_coverage])
 
-    # Finalize and write to file
-    plt.tight_layout()
-    plt.savefig(outfile)
-    plt.close()
 
-
-def plot_coverage_prrt(aafile, outfile, min_coverage=1000):
+def draw_coverage_prrt(coverage, ax, min_coverage=1000, scale=1):
     """
-    Write a PDF plot to `outfile` showing the coverage in the PR/RT/IN
-    region of the pol gene.
+    Draw the `coverage` in the PR/RT/IN region of the pol gene, by
+    serialized x coordinate, on the axes `ax`, with the tick label font
+    sizes multiplied by `scale`.
     """
-    aa = pd.read_excel(aafile)
-
-    # Initialize plot
-    fig, ax = plt.subplots(1, 1, figsize=(10, 1.5))
-
-    # Serialize the X coordinates for PR, RT, IN
-    aa["x"] = aa["position"]
-    aa.loc[aa["region"] == "RT", "x"] = aa.loc[aa["region"] == "RT", "position"] + 100
-    aa.loc[aa["region"] == "IN", "x"] = aa.loc[aa["region"] == "IN", "position"] + 541
-    del aa["region"]
-    del aa["position"]
-
-    # Calculate total coverage
-    coverage = aa.groupby("x")["coverage"].sum()
     max_coverage = coverage.max()
 
     # Plot coverage
@@ -96,49 +160,40 @@ def plot_coverage_prrt(aafile, outfile, min_coverage=1000):
     xlabels = ["PR", "RT", "IN"]
     ax.set_xlim(*xlim)
     ax.set_xticks(xticks)
-    ax.set_xticklabels(xlabels, fontsize=12)
+    ax.set_xticklabels(xlabels, fontsize=12*scale)
     ax.grid(axis="x")
 
     # Setup y axis
     ax.set_ylim(0, max(min_coverage, max_coverage))
     ax.set_yticks([min_coverage, max_coverage])
 
-    # Finalize and write to file
-    plt.tight_layout()
-    plt.savefig(outfile)
-    plt.close()
 
-
-def plot_drms(aafile, drmfile, column, outfile, yticks=[0.1, 1, 5, 10, 20, 50, 100], drmfreq=0.01):
+def _select_drms(drm, column, drmfreq=0.01):
     """
-    Write a PDF plot to `outfile` showing DRMs identified by `column`.
-    Return a dictionary of DRMs by PI/NRTI/NNRTI/INSTI.
+    Returns the DRMs in `drm` identified by `column` with frequency >=
+    `drmfreq`.
     """
-    aa = pd.read_excel(aafile)
-    drm = pd.read_csv(drmfile)
-    drm = drm[(drm[column] == 1) & (drm["frequency"] >= drmfreq)]
+    return drm[(drm[column] == 1) & (drm["frequency"] >= drmfreq)]
 
-    # Initialize plot
-    fig, ax = plt.subplots(1, 1, figsize=(15, 3))
 
-    # Serialize the X coordinates for PR, RT, IN
-    aa["x"] = aa["position"]
-    aa.loc[aa["region"] == "RT", "x"] = aa.loc[aa["region"] == "RT", "position"] + 100
-    aa.loc[aa["region"] == "IN", "x"] = aa.loc[aa["region"] == "IN", "position"] + 541
-    del aa["region"]
-    del aa["position"]
-
-    drm["x"] = drm["position"]
-    drm.loc[drm["region"] == "RT", "x"] = drm.loc[drm["region"] == "RT", "position"] + 100
-    drm.loc[drm["region"] == "IN", "x"] = drm.loc[drm["region"] == "IN", "position"] + 541
+def _by_drug(drm):
+    """
+    Returns a dictionary of the DRMs in `drm` by PI/NRTI/NNRTI/INSTI.
+    """
+    drms = defaultdict(list)
+    for row in drm.itertuples():
+        drms[row.drug].append("".join(map(str, [row.consensus, row.position, row.variant])))
+    return dict((drug, ", ".join(drms[drug])) for drug in drms)
 
-    # Calculate total coverage
-    coverage = aa.groupby("x")["coverage"].sum()
 
-    # Unpivot and remove zero- or low-coverage calls
-    del aa["hxb2"]
-    aa = aa.melt(id_vars=["x", "coverage"], var_name="variant", value_name="count")
-    aa["frequency"] = aa["count"] / aa["coverage"]
+def draw_drms(frequencies, drm, column, ax, yticks=[0.1, 1, 5, 10, 20, 50, 100], drmfreq=0.01, scale=1):
+    """
+    Draw the variant `frequencies` and the DRMs in `drm` identified by
+    `column` on the axes `ax`, with font sizes and line widths multiplied by
+    `scale`.
+    Return a dictionary of DRMs by PI/NRTI/NNRTI/INSTI.
+    """
+    drm = _select_drms(drm, column, drmfreq)
 
     # X axis
     margin = 1.5
@@ -146,41 +201,135 @@ def plot_drms(aafile, drmfile, column, outfile, yticks=[0.1, 1, 5, 10, 20, 50, 1
     xlabels = [1] + list(range(10, 100, 10)) + [1] + list(range(10, 440, 10)) + [1] + list(range(10, 269, 10))
     ax.set_xlim(1-margin, 811+margin)
     ax.set_xticks(xticks)
-    ax.set_xticklabels(xlabels, fontsize=9, rotation=90)
-    ax.set_xlabel("AA Position", size=14)
+    ax.set_xticklabels(xlabels, fontsize=9*scale, rotation=90)
+    ax.set_xlabel("AA Position", size=14*scale)
     ax.xaxis.set_minor_locator(FixedLocator(list(range(1, 811))))
     ax.xaxis.set_tick_params(direction="out")
 
     # Y axis
-    ax.set_ylabel("AA Frequency", size=14)
+    ax.set_ylabel("AA Frequency", size=14*scale)
     ax.set_yscale("log")
     ax.set_ylim(0.9*yticks[0], 1.1*yticks[-1])
     ax.set_yticks(yticks)
-    ax.set_yticklabels(['%g%%' % i for i in yticks], size=14)
+    ax.set_yticklabels(['%g%%' % i for i in yticks], size=14*scale)
     ax.get_yaxis().set_tick_params(direction="out")
 
     # Grid
     ax.grid(True, which="major")
-    ax.axvline(x=100, lw=1.0, color="k")
-    ax.axvline(x=541, lw=1.0, color="k")
+    ax.axvline(x=100, lw=1.0*scale, color="k")
+    ax.axvline(x=541, lw=1.0*scale, color="k")
 
     # Scatterplot
-    ax.scatter(aa["x"], 100*aa["frequency"], ec="k", alpha=0.5, marker=".", fc="none")
+    ax.scatter(frequencies["x"], 100*frequencies["frequency"], ec="k", alpha=0.5, marker=".", fc="none")
 
     # Annotate DRMs
     if len(drm) > 0:
         ax.scatter(drm["x"], 100*drm["frequency"], fc="r", marker=".", ec="none")
         ax.scatter(drm["x"], 100*drm["frequency"], ec="r", marker="o", fc="none")
 
-    # Finalize and write to file
-    plt.tight_layout()
-    plt.savefig(outfile)
-    plt.close()
+    return _by_drug(drm)
 
-    drms = defaultdict(list)
-    for row in drm.itertuples():
-        drms[row.drug].append("".join(map(str, [row.consensus, row.position, row.variant])))
-    return dict((drug, ", ".join(drms[drug])) for drug in drms)
+
+# Size in inches of the standalone figure drawn by each function
+_figsizes = {draw_coverage: (10, 2), draw_coverage_prrt: (10, 1.5), draw_drms: (15, 3)}
+
+
+def _figure(draw, args, outfile, **kwargs):
+    """
+    Draw a standalone figure with the function `draw` on `args` and
+    `kwargs`, write it to `outfile`, and return the result of `draw`.
+    """
+    fig, ax = plt.subplots(1, 1, figsize=_figsizes[draw])
+    result = draw(*args, ax, **kwargs)
+    fig.tight_layout()
+    fig.savefig(outfile)
+    plt.close(fig)
+    return result
+
+
+def plot_coverage(codonfile, outfile, min_coverage=1000):
+    """
+    Write a PDF plot to `outfile` showing the coverage at each HXB2 position
+    based on the codon counts in `codonfile`.
+    """
+    _figure(draw_coverage, (_load_coverage(codonfile),), outfile, min_coverage=min_coverage)
+
+
+def plot_coverage_prrt(aafile, outfile, min_coverage=1000):
+    """
+    Write a PDF plot to `outfile` showing the coverage in the PR/RT/IN
+    region of the pol gene.
+    """
+    _figure(draw_coverage_prrt, (_load_aa(aafile)[0],), outfile, min_coverage=min_coverage)
+
+
+def plot_drms(aafile, drmfile, column, outfile, yticks=[0.1, 1, 5, 10, 20, 50, 100], drmfreq=0.01):
+    """
+    Write a PDF plot to `outfile` showing DRMs identified by `column`.
+    Return a dictionary of DRMs by PI/NRTI/NNRTI/INSTI.
+    """
+    return _figure(draw_drms, (_load_aa(aafile)[1], _load_drms(drmfile), column), outfile,
+                   yticks=yticks, drmfreq=drmfreq)
+
+
+def _draw(name, draw, args):
+    """
+    Run the figure function `draw` on `args` and return its result, with a
+    record of its wall and CPU time.
+    """
+    start = time.perf_counter()
+    cpu = time.process_time()
+    result = draw(*args)
+    return result, OrderedDict([("name", "plot"),
+                                ("figure", name),
+                                ("wall_s", round(time.perf_counter() - start, 3)),
+                                ("cpu_s", round(time.process_time() - cpu, 3))])
+
+
+def render(codonfile, aafile, drmfile, outdir, processes=1, jobs=None):
+    """
+    Load the data for the report once (see `load`), and write its five
+    figures to `outdir`: coverage.pdf, coverage-prrt.pdf, and drms.pdf,
+    drmi.pdf and sdrm.pdf for the Stanford, IAS and SDRM lists of DRMs.
+
+    With `processes` > 1, up to that many figures are rendered at a time in
+    worker processes.
+
+    If `jobs` is a list, a record of the wall and CPU time of each figure
+    is appended to it.
+
+    Returns the DRMs by drug class (see `draw_drms`) for the Stanford, IAS
+    and SDRM figures.
+    """
+    data = load(codonfile, aafile, drmfile)
+    # The DRM figures take the longest, so they are started first
+    figures = [("drms.pdf", draw_drms, (data.frequencies, data.drms, "Stanford")),
+               ("drmi.pdf", draw_drms, (data.frequencies, data.drms, "IAS")),
+               ("sdrm.pdf", draw_drms, (data.frequencies, data.drms, "SDRM")),
+               ("coverage.pdf", draw_coverage, (data.coverage,)),
+               ("coverage-prrt.pdf", draw_coverage_prrt, (data.prrt_coverage,))]
+    tasks = [(name, _figure, (draw, args, os.path.join(outdir, name))) for name, draw, args in figures]
+    if processes > 1:
+        with ProcessPoolExecutor(max_workers=min(processes, len(tasks))) as executor:
+            results = list(executor.map(_draw, *zip(*tasks)))
+    else:
+        results = [_draw(*task) for task in tasks]
+    if jobs is not None:
+        jobs.extend(usage for _, usage in results)
+    return [result for result, _ in results[:3]]
+
+
+def _summarize_fastq(fastq):
+    """
+    Returns a line for each FASTQ file in `fastq` with its size and date.
+    """
+    lines = []
+    for f in fastq:
+        st = os.stat(f)
+        mb = st.st_size / 1048576
+        ts = time.strftime("%-d %b %Y", time.localtime(st.st_mtime))
+        lines.append("%s (%.1f MB, %s)" % (f, mb, ts))
+    return lines
 
 
 def compile(fastq, coveragefile, coverageprrtfile,
@@ -194,12 +343,7 @@ def compile(fastq, coveragefile, coverageprrtfile,
     name = os.path.basename(fastq[0]).partition("_")[0]
 
     # Summarize FASTQ input files
-    fastq_summary = []
-    for f in fastq:
-        st = os.stat(f)
-        mb = st.st_size / 1048576
-        ts = time.strftime("%-d %b %Y", time.localtime(st.st_mtime))
-        fastq_summary.append(r"%s (%.1f MB, %s) \\" % (f, mb, ts))
+    fastq_summary = [r"%s \\" % line for line in _summarize_fastq(fastq)]
     fastq_summary[-1] = fastq_summary[-1] + "[3pt]"
     fastq_summary = "\n".join(fastq_summary)
 
@@ -262,4 +406,160 @@ def compile(fastq, coveragefile, coverageprrtfile,
     return outfile
 
 
+class _Pages(object):
+    """
+    Lays out lines of text and figures down letter-sized pages of the
+    `PdfPages` file `pdf`, starting a new page whenever the next line or
+    figure would cross the bottom margin. Positions are in inches from the
+    top left corner of the page.
+    """
+
+    width, height, margin = 8.5, 11.0, 0.5
+
+    def __init__(self, pdf):
+        self.pdf = pdf
+        self.fig = None
+        self.new_page()
+
+    def new_page(self):
+        """
+        Write the current page, if any, and start a new one.
+        """
+        if self.fig is not None:
+            self.pdf.savefig(self.fig)
+            plt.close(self.fig)
+        self.fig = plt.figure(figsize=(self.width, self.height))
+        self.y = self.margin
+
+    def close(self):
+        """
+        Write the last page.
+        """
+        self.pdf.savefig(self.fig)
+        plt.close(self.fig)
+        self.fig = None
+
+    def keep(self, h):
+        """
+        Start a new page unless the next `h` inches fit on this one, or
+        nothing has been laid out on it yet.
+        """
+        if self.y + h > self.height - self.margin and self.y > self.margin:
+            self.new_page()
+
+    def _box(self, left, top, w, h):
+        """
+        Returns the `w` by `h` inch box at `left`, `top` in figure
+        coordinates.
+        """
+        return [left / self.width, 1 - (top + h) / self.height, w / self.width, h / self.height]
+
+    def wrap(self, s, size=8):
+        """
+        Returns the lines of `s`, with mathtext escaped, wrapped at the width
+        of the page.
+        """
+        return textwrap.wrap(s.replace("$", r"\$"), int(16 * (self.width - 2 * self.margin) * 8 / size)) or [""]
+
+    def text(self, s, size=8, weight="normal", style="normal", space=1.3):
+        for line in self.wrap(s, size):
+            self.keep(size * space / 72)
+            self.y += size * space / 72
+            self.fig.text(self.margin / self.width, 1 - self.y / self.height, line,
+                          size=size, weight=weight, style=style, va="baseline")
+
+    def figure_height(self, draw):
+        """
+        Returns the height in inches that `figure` lays out for `draw`.
+        """
+        w, h = _figsizes[draw]
+        return (self.width - 2 * self.margin) * h / w + 0.15
+
+    def figure(self, draw, args):
+        """
+        Draw a figure with the function `draw` on `args` across the width of
+        the page, as its standalone figure (see `_figure`) would look scaled
+        down to fit, and return the result of `draw`.
+        """
+        w = self.width - 2 * self.margin
+        scale = w / _figsizes[draw][0]
+        h = scale * _figsizes[draw][1]
+        self.keep(h + 0.15)
+        self.y += 0.05
+        existing = set(self.fig.axes)
+        with plt.rc_context(_scaled(scale)):
+            result = draw(*args, self.fig.add_axes(self._box(self.margin, self.y, w, h)), scale=scale)
+            self._fit([ax for ax in self.fig.axes if ax not in existing], self.margin, self.y, w, h)
+        self.y += h + 0.1
+        return result
+
+    def _fit(self, axes, left, top, w, h):
+        """
+        Position `axes`, which share a position, so that they fill the box
+        `w` by `h` inches at `left`, `top` with their tick and axis labels,
+        like `tight_layout` does for a whole figure.
+        """
+        pad = 1.08 * matplotlib.rcParams["font.size"] / 72
+        renderer = self.fig.canvas.get_renderer()
+        outer = Bbox.union([ax.get_tightbbox(renderer) for ax in axes])
+        inner = axes[0].get_window_extent(renderer)
+        dpi = self.fig.dpi
+        l = (inner.x0 - outer.x0) / dpi + pad
+        r = (outer.x1 - inner.x1) / dpi + pad
+        t = (outer.y1 - inner.y1) / dpi + pad
+        b = (inner.y0 - outer.y0) / dpi + pad
+        box = self._box(left + l, top + t, w - l - r, h - t - b)
+        for ax in axes:
+            ax.set_position(box)
+
+
+def assemble(fastq, codonfile, aafile, drmfile, outfile):
+    """
+    Write a PDF report to `outfile` containing coverage, DRM, and SDRM plots
+    of the codon counts in `codonfile`, the amino acid table in `aafile` and
+    the DRMs in `drmfile`, with the same layout as `compile`, but drawn by
+    matplotlib onto letter pages instead of compiled with LaTeX.
+
+    The plots are drawn directly on the pages as vector graphics. The report
+    continues on a new page if a long list of DRMs pushes a plot past the
+    bottom of the first.
+    """
+
+    name = os.path.basename(fastq[0]).partition("_")[0]
+    data = load(codonfile, aafile, drmfile)
+
+    def summary(drugs):
+        return "PI: %s    NRTI: %s    NNRTI: %s    INSTI: %s" % \
+               tuple(drugs.get(drug, "n/a") for drug in ("PI", "NRTI", "NNRTI", "INSTI"))
+
+    outfile = os.path.abspath(outfile)
+    with PdfPages(outfile, metadata={"Title": "hivmmer report: %s" % name,
+                                     "Creator": "hivmmer %s" % hivmmer.__version__}) as pdf:
+        pages = _Pages(pdf)
+
+        pages.text("Dataset: %s" % name, size=11, weight="bold")
+        pages.text("Report generated on %s by hivmmer %s from input:" % (datetime.now().ctime(), hivmmer.__version__),
+                   style="italic")
+        for line in _summarize_fastq(fastq):
+            pages.text(line)
+        pages.y += 0.05
+
+        for title, draw, args, column in (("Coverage: Whole Genome", draw_coverage, (data.coverage,), None),
+                                          ("Coverage: PR/RT/IN", draw_coverage_prrt, (data.prrt_coverage,), None),
+                                          ("DRMs: Stanford", draw_drms, (data.frequencies, data.drms, "Stanford"), "Stanford"),
+                                          ("DRMs: IAS", draw_drms, (data.frequencies, data.drms, "IAS"), "IAS"),
+                                          ("SDRMs: Stanford", draw_drms, (data.frequencies, data.drms, "SDRM"), "SDRM")):
+            drugs = None if column is None else summary(_by_drug(_select_drms(data.drms, column)))
+            # Keep each title with its DRMs and plot, if they fit on a page
+            nlines = 0 if drugs is None else len(pages.wrap(drugs))
+            pages.keep(9 * 1.6 / 72 + nlines * 8 * 1.3 / 72 + pages.figure_height(draw))
+            pages.text(title, size=9, weight="bold", space=1.6)
+            if drugs is not None:
+                pages.text(drugs)
+            pages.figure(draw, args)
+
+        pages.close()
+    return outfile
+
+
 # vim: expandtab sw=4 ts=4
@@ -0,0 +1,108 @@
+"""
+"""
+import numpy as np
+import sys
+from collections import OrderedDict
+from . import data
+from .translate import read_fasta
+
+# Amino acid k-mers are packed into integers with 5 bits per residue, so the
+# index is a dense table of 32**k gene bitmasks.
+_bits = 5
+_alphabet = "ACDEFGHIKLMNPQRSTVWY"
+
+def _lookup_table():
+    """
+    Map each byte to a residue code, or 0 for anything other than the 20
+    unambiguous amino acids (X, *, ...), which never match. Code 0 is
+    therefore never part of an indexed k-mer.
+    """
+    codes = np.zeros(256, dtype=np.int64)
+    for i, aa in enumerate(_alphabet):
+        codes[ord(aa)] = i + 1
+        codes[ord(aa.lower())] = i + 1
+    return codes
+
+_codes = _lookup_table()
+
+def encode(seqs, k):
+    """
+    Returns the packed integer of every k-mer in the concatenated sequences
+    `seqs`, with 0 for k-mers that contain an unmatched residue or span two
+    sequences, and the offsets of each sequence's k-mers.
+    """
+    lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+    codes = _codes[np.frombuffer("".join(seqs).encode("ascii"), dtype=np.uint8)]
+    n = max(len(codes) - k + 1, 0)
+    kmers = np.zeros(n, dtype=np.int64)
+    valid = np.ones(n, dtype=bool)
+    for i in range(k):
+        kmers = (kmers << _bits) | codes[i:i+n]
+        valid &= codes[i:i+n] > 0
+    # Only keep the k-mers that start within each sequence
+    nkmers = np.maximum(lengths - k + 1, 0)
+    starts = np.cumsum(lengths) - lengths
+    offsets = np.concatenate(([0], np.cumsum(nkmers)))
+    positions = np.repeat(starts, nkmers) + (np.arange(offsets[-1]) - np.repeat(offsets[:-1], nkmers))
+    return np.where(valid[positions], kmers[positions], 0), offsets
+
+def index(genes, k=5):
+    """
+    Build a k-mer index of the HMM consensus (`hmmaa`) and HXB2 (`hxb2aa`)
+    amino acid sequences of the prepackaged pHMMs for `genes` (at most 8).
+
+    Returns a table of 32**`k` bitmasks, in which bit i is set if the k-mer
+    occurs in the i-th gene.
+    """
+    assert len(genes) <= 8
+    table = np.zeros(1 << (_bits * k), dtype=np.uint8)
+    for i, gene in enumerate(genes):
+        ref = data.table("{}.hxb2".format(gene))
+        seqs = ["".join(ref[column].tolist()).replace("-", "").replace(".", "").upper() for column in ("hmmaa", "hxb2aa")]
+        kmers, _ = encode(seqs, k)
+        table[kmers[kmers > 0]] |= 1 << i
+    return table
+
+def route(pfafile, genes, prefix, k=5, min_hits=2, log=sys.stderr, batchsize=10000):
+    """
+    Assign each translated sequence in FASTA file `pfafile` to the genes in
+    `genes` with which it shares at least `min_hits` amino acid k-mers, and
+    write the sequences assigned to each gene to `{prefix}.{gene}.pfa`.
+
+    Log the number of sequences routed to each gene to file `log`.
+
+    Returns an ordered dictionary mapping each gene to its FASTA file, and
+    the total number of sequences in `pfafile`.
+    """
+    table = index(genes, k)
+    subsets = OrderedDict((gene, "{}.{}.pfa".format(prefix, gene)) for gene in genes)
+    files = [open(subset, "w") for subset in subsets.values()]
+    nseqs = 0
+    nrouted = np.zeros(len(genes), dtype=np.int64)
+    nunrouted = 0
+    try:
+        for batch in read_fasta(pfafile, batchsize):
+            kmers, offsets = encode([seq for _, seq in batch], k)
+            masks = table[kmers]
+            # Count the k-mer hits for each gene in each sequence
+            hits = np.zeros((len(genes), len(batch)), dtype=np.int64)
+            nonempty = offsets[1:] > offsets[:-1]
+            for i in range(len(genes)):
+                if len(masks):
+                    hits[i, nonempty] = np.add.reduceat((masks >> i) & 1, offsets[:-1][nonempty], dtype=np.int64)
+            routed = hits >= min_hits
+            nseqs += len(batch)
+            nrouted += routed.sum(axis=1)
+            nunrouted += int((~routed.any(axis=0)).sum())
+            for f, mask in zip(files, routed):
+                f.write("".join(">{}\n{}\n".format(id, seq) for (id, seq), keep in zip(batch, mask) if keep))
+    finally:
+        for f in files:
+            f.close()
+    print("nseqs", nseqs, file=log)
+    for gene, n in zip(genes, nrouted.tolist()):
+        print("nrouted", gene, n, file=log)
+    print("nunrouted", nunrouted, file=log)
+    return subsets, nseqs
+
+# vim: expandtab sw=4 ts=4
@@ -1,11 +1,16 @@
 """
 """
 
+import hivmmer
 import numpy as np
 import os
 import pandas as pd
 import sys
 from Bio import Seq
+from collections import OrderedDict
+from hivmmer import counts
+from hivmmer import data
+from hivmmer.codons import translation
 
 aa_header = ["A", "C", "D", "E", "F", "G", "H", "I", "K", "L", "M", "N", "P", "Q", "R", "S", "T", "V", "W", "Y", "*", "X", "del", "ins"]
 
@@ -15,33 +20,149 @@ ranges = {
     "IN": range(4230, 5037, 3)
 }
 
-def aa_table(codonfile, outfile):
+# The gene that each of the `ranges` belongs to
+regions = {"PR": "pol", "RT": "pol", "IN": "pol"}
+
+def _aa_matrix():
     """
+    Map each column of the codon count matrix to its column in `aa_header`,
+    as a 0/1 matrix, so that amino acid counts are a single matrix product.
+    Ambiguous codons are not counted, as in `CodonCounts.to_frame`.
     """
-    codons = pd.read_csv(codonfile, sep="\t", index_col="hxb2").fillna("")
-    subtables = []
+    columns = dict((aa, i) for i, aa in enumerate(aa_header))
+    matrix = np.zeros((counts.ncolumns, len(aa_header)), dtype=np.int64)
+    for codon, i in counts.columns.items():
+        matrix[i, columns[translation[codon]]] = 1
+    matrix[counts.DELETION, columns["del"]] = 1
+    return matrix
+
+_aa = _aa_matrix()
+
+def gene_ranges(genes=None):
+    """
+    Returns an ordered dictionary with the range of HXB2 coordinates of the
+    codon count rows for each gene in `genes` (by default, `hivmmer.genes`).
+    """
+    ranges = OrderedDict()
+    for gene in (hivmmer.genes if genes is None else genes):
+        hxb2 = data.hxb2_index(gene)[0]
+        ranges[gene] = range(hxb2[1], hxb2[-1] + 1, 3)
+    return ranges
+
+def _label_genes(hxb2):
+    """
+    Returns the gene of each row of a count table with HXB2 coordinates
+    `hxb2`, which has a run of rows with increasing coordinates for each
+    gene, in the order of `hivmmer.genes`.
+    """
+    genes = gene_ranges()
+    names = list(genes)
+    hxb2 = hxb2.tolist()
+    labels = np.empty(len(hxb2), dtype=object)
+    start = 0
+    g = 0
+    while start < len(hxb2):
+        while g < len(names) and hxb2[start] not in genes[names[g]]:
+            g += 1
+        assert g < len(names), "HXB2 coordinate {} is not in any gene".format(hxb2[start])
+        end = start + 1
+        while end < len(hxb2) and hxb2[end] > hxb2[end-1] and hxb2[end] in genes[names[g]]:
+            end += 1
+        labels[start:end] = names[g]
+        start = end
+        g += 1
+    return labels
+
+def aa_counts(codons):
+    """
+    Count amino acids, deletions and insertions at each row of the
+    `hivmmer.counts.CodonCounts` table `codons`.
+
+    The 64 unambiguous codons and deletions are counted with a single matrix
+    product, and the distinct codons in the sparse `extra` table are
+    translated once each. Insertions (codons longer than three nucleotides)
+    count both as an insertion and as the amino acid of their first codon.
+
+    Returns a data frame indexed by HXB2 position with the gene of each row,
+    the coverage (sum of the counts) and a column for each entry of
+    `aa_header`.
+    """
+    table = codons.counts.dot(_aa)
+    if codons.extra:
+        columns = dict((aa, i) for i, aa in enumerate(aa_header))
+        translated = {}
+        for (row, codon), n in codons.extra.items():
+            if codon == "":
+                table[row, columns["del"]] += n
+                continue
+            if len(codon) > 3:
+                table[row, columns["ins"]] += n
+                codon = codon[:3]
+            aa = translated.get(codon)
+            if aa is None:
+                aa = translated[codon] = str(Seq.translate(codon))
+            table[row, columns.get(aa, columns["X"])] += n
+    frame = pd.DataFrame(table, columns=aa_header, index=pd.Index(codons.hxb2, name="hxb2"))
+    frame.insert(0, "gene", _label_genes(codons.hxb2))
+    frame.insert(1, "coverage", table.sum(axis=1))
+    return frame
+
+def aa_table(codonfile, outfile, genes=None):
+    """
+    Write a table `outfile` of amino acid counts at each position in the PR,
+    RT and IN `ranges` of pol, from the codon counts in `codonfile`.
+
+    If `genes` is a list of genes, such as `hivmmer.genes`, the table has a
+    region for each whole gene instead.
 
-    for region in ranges:
-        subtable = pd.DataFrame(columns=["region", "position", "coverage"]+aa_header,
-                                index=ranges[region]).fillna(0)
-        subtable["region"] = region
-        subtable["position"] = np.arange(1, len(subtable)+1)
-        for hxb2 in subtable.index:
-            if hxb2 in codons.index:
-                rows = codons.loc[[hxb2]]
-                for codon, count in zip(rows["codon"], rows["count"]):
-                    if codon == "":
-                        subtable.loc[hxb2, "del"] += count
-                    elif len(codon) > 3:
-                        subtable.loc[hxb2, "ins"] += count
-                        aa = str(Seq.translate(codon[:3]))
-                        subtable.loc[hxb2, aa] += count
-                    else:
-                        aa = str(Seq.translate(codon))
-                        subtable.loc[hxb2, aa] += count
-        subtable["coverage"] = subtable[aa_header].sum(axis=1)
+    The table is written in NumPy .npz format if `outfile` ends in .npz (see
+    `write`), and otherwise as an Excel spreadsheet.
+    """
+    frame = aa_counts(counts.read(codonfile))
+    if genes is None:
+        selected = [(region, regions[region], hxb2) for region, hxb2 in ranges.items()]
+    else:
+        selected = [(gene, gene, hxb2) for gene, hxb2 in gene_ranges(genes).items()]
+
+    subtables = []
+    for region, gene, hxb2 in selected:
+        subtable = frame[frame["gene"] == gene].drop(columns="gene").reindex(hxb2, fill_value=0)
+        subtable.insert(0, "region", region)
+        subtable.insert(1, "position", np.arange(1, len(subtable)+1))
         subtables.append(subtable)
 
-    pd.concat(subtables).to_excel(outfile, index_label="hxb2")
+    write(pd.concat(subtables).reset_index(), outfile)
+
+def write(aa, outfile):
+    """
+    Write the amino acid table `aa` to `outfile`, either as a NumPy .npz file
+    with one array per column, which loads in milliseconds, or as an Excel
+    spreadsheet for export.
+    """
+    if outfile.endswith(".npz"):
+        arrays = {}
+        for i, column in enumerate(aa.columns):
+            if pd.api.types.is_numeric_dtype(aa[column]):
+                arrays[str(i)] = aa[column].to_numpy()
+            else:
+                arrays[str(i)] = np.array(aa[column].tolist(), dtype=np.str_)
+        np.savez_compressed(outfile, columns=np.array(aa.columns, dtype=np.str_), **arrays)
+    else:
+        aa.to_excel(outfile, index=False)
+
+def read_frame(aafile):
+    """
+    Read an amino acid table from either a NumPy .npz file or an Excel
+    spreadsheet written by `aa_table` into a data frame.
+    """
+    if aafile.endswith(".npz"):
+        aa = OrderedDict()
+        with np.load(aafile) as npz:
+            for i, column in enumerate(npz["columns"].tolist()):
+                values = npz[str(i)]
+                # Strings as Python objects, as pd.read_excel returns them
+                aa[column] = values.astype(object) if values.dtype.kind == "U" else values
+        return pd.DataFrame(aa)
+    return pd.read_excel(aafile)
 
 # vim: expandtab sw=4 ts=4
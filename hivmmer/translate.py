@@ -1,47 +1,207 @@
 import argparse
+import numpy as np
 import sys
-from Bio import Seq
-from Bio import SeqIO
+from itertools import product
+from hivmmer.reads import ReadStore
 
+# Nucleotide symbols handled by the vectorized translation: the four bases
+# and the IUPAC ambiguity codes, in either case. Reads with any other symbol
+# fall back to Biopython.
+_symbols = "ACGTRYSWKMBDHVN"
+_complements = "TGCAYRSWMKVHDBN"
 
-def translate(filename, out=sys.stdout, log=sys.stderr):
-    """
-    Translate nucleotide sequences in FASTA file `filename` to all six possible
-    frames.
+_tables = None
 
-    Write amino acid sequences to FASTA file `out`, with the frame number
-    appended to the sequence header.
+def _lookup_tables():
+    """
+    Precompute a table mapping each byte to a nucleotide code (or -1), the
+    complement of each code, and the amino acid for every codon of codes.
 
-    Log summary statistics to file `log`.
+    The tables are built with Biopython on first use, and cached.
+    """
+    global _tables
+    if _tables is None:
+        from Bio import Seq
+        codes = np.full(256, -1, dtype=np.int64)
+        for i, nt in enumerate(_symbols):
+            codes[ord(nt)] = i
+            codes[ord(nt.lower())] = i
+        complements = np.array([_symbols.index(nt) for nt in _complements], dtype=np.int64)
+        n = len(_symbols)
+        table = np.zeros(n ** 3, dtype=np.uint8)
+        for i, codon in enumerate(product(_symbols, repeat=3)):
+            table[i] = ord(str(Seq.translate("".join(codon))))
+        _tables = codes, complements, table
+    return _tables
+
+
+def _parse_fasta(handle):
+    """
+    Yield (id, sequence) records from FASTA file `handle`.
     """
+    id = None
+    lines = []
+    for line in handle:
+        if line.startswith(">"):
+            if id is not None:
+                yield id, "".join(lines)
+            title = line[1:].strip()
+            id = title.split(None, 1)[0] if title else ""
+            lines = []
+        elif id is not None:
+            lines.append(line.strip())
+    if id is not None:
+        yield id, "".join(lines)
+
+
+def _records(filename):
+    if isinstance(filename, ReadStore):
+        yield from filename.records()
+    elif hasattr(filename, "read"):
+        yield from _parse_fasta(filename)
+    else:
+        with open(filename) as f:
+            yield from _parse_fasta(f)
 
-    nskipped = 0
 
-    for n, record in enumerate(SeqIO.parse(filename, "fasta")):
+def read_fasta(filename, batchsize):
+    """
+    Yield batches of up to `batchsize` (id, sequence) records from FASTA
+    `filename`, which can be a path or an open file, or from a
+    `hivmmer.reads.ReadStore`.
+    """
+    batch = []
+    for record in _records(filename):
+        batch.append(record)
+        if len(batch) == batchsize:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
-        seq = str(record.seq)
 
-        if 'N' in seq:
-            nskipped += 1
-            continue
+def _translate_batch(seqs):
+    """
+    Translate the sequences in list `seqs` in all six frames.
 
+    Returns a list with one entry per frame (0, 1, 2, 0', 1', 2'), each a
+    tuple of the concatenated amino acid bytes and the offsets of each
+    sequence's translation in them, and a mask of the sequences that contain
+    symbols outside of the lookup tables, whose translations are invalid.
+    """
+    lookup, complements, table = _lookup_tables()
+    lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    codes = lookup[np.frombuffer("".join(seqs).encode("ascii"), dtype=np.uint8)]
+    unknown = np.concatenate(([0], np.cumsum(codes < 0)))
+    unknown = (unknown[ends] - unknown[starts]) > 0
+    codes[codes < 0] = 0
+    n = len(_symbols)
+
+    # The reverse complement of the whole batch reverses the order of the
+    # sequences as well, so sequence i starts at total - ends[i]
+    strands = ((codes, starts), (complements[codes[::-1]], len(codes) - ends))
+
+    frames = []
+    for strand, strand_starts in strands:
         for i in range(3):
-            j = 3 * ((len(seq) - i) // 3) + i
-            print(">%s-%d" % (record.id, i), file=out)
-            print(Seq.translate(seq[i:j]), file=out)
+            ncodons = np.maximum((lengths - i) // 3, 0)
+            offsets = np.concatenate(([0], np.cumsum(ncodons)))
+            # Position of each codon in the strand
+            k = np.arange(offsets[-1]) - np.repeat(offsets[:-1], ncodons)
+            positions = np.repeat(strand_starts + i, ncodons) + 3 * k
+            aa = table[strand[positions] * n * n + strand[positions + 1] * n + strand[positions + 2]]
+            frames.append((aa, offsets))
+    return frames, unknown
 
-        seq = str(record.seq.reverse_complement())
 
+def _translate_batches(filename, batchsize):
+    """
+    Yield each batch of records in `filename` with its six frame
+    translations. Sequences with symbols outside of the lookup tables are
+    translated one at a time with Biopython.
+    """
+    for batch in read_fasta(filename, batchsize):
+        seqs = [seq if seq.isascii() else "" for _, seq in batch]
+        frames, unknown = _translate_batch(seqs)
+        frames = [(aa.tobytes().decode("ascii"), offsets.tolist()) for aa, offsets in frames]
+        translations = []
+        for r, ((_, seq), fallback) in enumerate(zip(batch, unknown.tolist())):
+            if fallback or not seq.isascii():
+                translations.append(_translate_seq(seq))
+            else:
+                translations.append([aa[offsets[r]:offsets[r+1]] for aa, offsets in frames])
+        yield batch, translations
+
+
+def _translate_seq(seq):
+    """
+    Translate `seq` in all six frames with Biopython.
+    """
+    from Bio import Seq
+    translations = []
+    for strand in (seq, Seq.reverse_complement(seq)):
         for i in range(3):
-            j = 3 * ((len(seq) - i) // 3) + i
-            print(">%s-%d'" % (record.id, i), file=out)
-            print(Seq.translate(seq[i:j]), file=out)
+            j = 3 * ((len(strand) - i) // 3) + i
+            translations.append(str(Seq.translate(strand[i:j])))
+    return translations
+
+
+_frames = ("0", "1", "2", "0'", "1'", "2'")
+
+
+def translate(filename, out=sys.stdout, log=sys.stderr, batchsize=10000, max_stops=None):
+    """
+    Translate nucleotide sequences in FASTA file `filename`, or in a
+    `hivmmer.reads.ReadStore`, to all six possible frames.
+
+    Write amino acid sequences to FASTA file `out`, with the frame number
+    appended to the sequence header.
+
+    If `max_stops` is not None, prune the frames with more than `max_stops`
+    internal stop codons (a stop codon at the end of the frame is allowed).
+    With `max_stops=0`, only frames without stop codons are kept.
+
+    Log summary statistics to file `log`.
+
+    Sequences are translated in batches of `batchsize` with NumPy lookup
+    tables, and written to `out` one batch at a time.
+
+    Returns the number of translated sequences written.
+    """
+
+    n = -1
+    nskipped = 0
+    nframes = 0
+    npruned = 0
+    nwritten = 0
+
+    for batch, translations in _translate_batches(filename, batchsize):
+        lines = []
+        for (id, seq), frames in zip(batch, translations):
+            n += 1
+            if 'N' in seq:
+                nskipped += 1
+                continue
+            for frame, tseq in zip(_frames, frames):
+                nframes += 1
+                if max_stops is not None and tseq.count("*", 0, len(tseq) - 1) > max_stops:
+                    npruned += 1
+                    continue
+                lines.append(">%s-%s\n%s\n" % (id, frame, tseq))
+        nwritten += len(lines)
+        out.write("".join(lines))
 
     print("nreads", n, file=log)
     print("nskipped (N)", nskipped, file=log)
+    if max_stops is not None:
+        print("nframes", nframes, file=log)
+        print("npruned (stop codons > {})".format(max_stops), npruned, file=log)
+    return nwritten
 
 
-def translate_unambiguous(filename, out=sys.stdout, log=sys.stderr, fraction=0.9):
+def translate_unambiguous(filename, out=sys.stdout, log=sys.stderr, fraction=0.9, batchsize=10000):
     """
     Translate nucleotide sequences in FASTA file `filename` to all six possible
     frames.
@@ -54,27 +214,16 @@ def translate_unambiguous(filename, out=sys.stdout, log=sys.stderr, fraction=0.9
     Log summary statistics to file `log`.
     """
 
-    nskipped = 0
-
-    for n, record in enumerate(SeqIO.parse(filename, "fasta")):
+    n = -1
 
-        seq = str(record.seq)
-
-        for i in range(3):
-            j = 3 * ((len(seq) - i) // 3) + i
-            tseq = Seq.translate(seq[i:j])
-            if sum(aa != 'X' for aa in tseq) / len(tseq) > fraction:
-                print(">%s-%d" % (record.id, i), file=out)
-                print(tseq, file=out)
-
-        seq = str(record.seq.reverse_complement())
-
-        for i in range(3):
-            j = 3 * ((len(seq) - i) // 3) + i
-            tseq = Seq.translate(seq[i:j])
-            if sum(aa != 'X' for aa in tseq) / len(tseq) > fraction:
-                print(">%s-%d'" % (record.id, i), file=out)
-                print(tseq, file=out)
+    for batch, translations in _translate_batches(filename, batchsize):
+        lines = []
+        for (id, seq), frames in zip(batch, translations):
+            n += 1
+            for frame, tseq in zip(_frames, frames):
+                if tseq and (len(tseq) - tseq.count("X")) / len(tseq) > fraction:
+                    lines.append(">%s-%s\n%s\n" % (id, frame, tseq))
+        out.write("".join(lines))
 
     print("nreads", n, file=log)
 
@@ -85,14 +234,18 @@ def _run():
     parser.add_argument("FASTA",
                         nargs=1,
                         help="path to nucleotide FASTA file, or '-' to read from stdin")
+    parser.add_argument("-s", "--max-stops",
+                        metavar="K",
+                        type=int,
+                        help="prune frames with more than K internal stop codons [keep all frames]")
     args = parser.parse_args()
 
     fasta = args.FASTA[0]
     if fasta == '-':
-        translate(sys.stdin, args.allow_stop_codons)
+        translate(sys.stdin, max_stops=args.max_stops)
     else:
         with open(fasta) as f:
-            translate(f)
+            translate(f, max_stops=args.max_stops)
 
 
 # vim: expandtab sw=4 ts=4
@@ -23,7 +23,7 @@ setup(
     provides=["hivmmer"],
     install_requires=["BioPython>=1.69", "matplotlib>=3.1.1", "numpy>=1.13.0", "openpyxl", "pandas>=0.22.0", "xlrd"],
     packages=find_packages(),
-    package_data={"hivmmer": ["VERSION", "*.csv", "*.hmm.*", "*.tsv"]},
+    package_data={"hivmmer": ["VERSION", "*.csv", "*.hmm.*", "*.npz", "*.tsv"]},
     scripts=["scripts/hivmmer"],
     entry_points={
         "console_scripts": ["hivmmer-consensus=hivmmer.consensus:_run",
@@ -0,0 +1,63 @@
+"""
+Regression check for the tabular hmmsearch output: search the translated
+reads from a run of test.sh with the pHMM of each gene, writing both the
+text output and a domain table with a Stockholm alignment, and check that
+`hivmmer.codons` counts the same codons from both, that is, that
+`hivmmer.hmmer.parse_tabular` agrees with `hivmmer.hmmer.parse`.
+
+Exits with status 1 if the counts of any gene differ.
+
+Usage: python tabular.py [OUTDIR]
+"""
+import argparse
+import hivmmer
+import numpy as np
+import os
+import shutil
+import sys
+import tempfile
+
+
+def same(a, b):
+    """
+    Returns whether the `hivmmer.counts.CodonCounts` tables `a` and `b` are
+    equal.
+    """
+    return (np.array_equal(a.hxb2, b.hxb2) and
+            np.array_equal(a.counts, b.counts) and
+            a.extra == b.extra)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("OUTDIR", nargs="?", default="out", help="output directory of test.sh [out]")
+    args = parser.parse_args()
+
+    store = hivmmer.reads.ReadStore(os.path.join(args.OUTDIR, "sequences", "deduplicated"))
+    pfafile = os.path.join(args.OUTDIR, "sequences", "translated.pfa")
+
+    failures = []
+    tmpdir = tempfile.mkdtemp()
+    try:
+        hivmmer.copy_hmms(tmpdir)
+        for gene in hivmmer.genes:
+            hmmfile = os.path.join(tmpdir, "{}.hmm".format(gene))
+            text = os.path.join(tmpdir, "{}.txt".format(gene))
+            tabular = (os.path.join(tmpdir, "{}.domtbl".format(gene)), os.path.join(tmpdir, "{}.sto".format(gene)))
+            hivmmer.pipeline.hmmsearch(hmmfile, pfafile, text, os.path.join(tmpdir, "{}.log".format(gene)))
+            hivmmer.pipeline.hmmsearch(hmmfile, pfafile, tabular, os.path.join(tmpdir, "{}.tabular.log".format(gene)))
+            expected = hivmmer.codons(store, text, gene)
+            observed = hivmmer.codons(store, tabular, gene)
+            ok = same(expected, observed)
+            print("{:<5} {:>10,} codons  {}".format(gene, int(expected.counts.sum()), "ok" if ok else "DIFFERENT"))
+            if not ok:
+                failures.append(gene)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if failures:
+        print("FAIL: tabular codon counts differ from text for", ", ".join(failures))
+    sys.exit(1 if failures else 0)
+
+# vim: expandtab sw=4 ts=4
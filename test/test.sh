@@ -1,2 +1,3 @@
 #!/bin/bash
 hivmmer -o out 5VM_?.fastq
+python tabular.py out